@@ -0,0 +1,111 @@
+"""Measure analysis throughput of the deep-queue client on a fixed set of games"""
+from default_imports import *
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+from conf.ConfigWrapper import ConfigWrapper
+
+from modules.game.Game import Game
+from modules.game.EngineTools import EngineTools
+
+from chess.uci import InfoHandler
+
+conf = ConfigWrapper.new(os.environ.get("IRWIN_CONFIG", "conf/client_config.json"))
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--games", dest="games", default="data/benchmarkGames.json",
+                help="JSON list of games to replay")
+parser.add_argument("--limit", dest="limit", type=int, default=None,
+                help="only replay the first LIMIT games")
+parser.add_argument("--nodes", dest="nodes", type=int, nargs="+", default=[100000],
+                help="node budgets to measure")
+parser.add_argument("--threads", dest="threads", type=int, nargs="+", default=[conf['stockfish threads']],
+                help="stockfish Threads settings to measure")
+parser.add_argument("--hash", dest="hash", type=int, nargs="+", default=[conf['stockfish memory']],
+                help="stockfish Hash settings (MB) to measure")
+
+class SearchTimer(InfoHandler):
+    """
+    Added after the EngineTools InfoHandler. The time between its pre_info and
+    post_info is spent parsing an info line into every handler; it also adds up
+    the nodes each search reports.
+    """
+    def __init__(self):
+        super(SearchTimer, self).__init__()
+        self.parsing = 0.0
+        self.nodesSearched = 0
+        self.started = None
+
+    def pre_info(self, line):
+        super(SearchTimer, self).pre_info(line)
+        self.started = time.perf_counter()
+
+    def post_info(self):
+        self.parsing += time.perf_counter() - self.started
+        super(SearchTimer, self).post_info()
+
+    def on_bestmove(self, bestmove, ponder):
+        self.nodesSearched += self.info.get('nodes', 0)
+        super(SearchTimer, self).on_bestmove(bestmove, ponder)
+
+def benchmark(games: List[Game], nodes: int, threads: int, memory: int) -> Dict:
+    """
+    Analyse every game from both sides with one engine and no caches
+    """
+    d = json.loads(json.dumps(conf.asdict()))
+    d['stockfish'].update({'threads': threads, 'memory': memory})
+    engineTools = EngineTools.new(ConfigWrapper(d))
+    timer = SearchTimer()
+    engineTools.engine.info_handlers.append(timer)
+
+    replay, search, positions = 0.0, 0.0, 0
+    try:
+        for game, colour in itertools.product(games, [True, False]):
+            start = time.perf_counter()
+            tasks = EngineTools.positionTasks(game, colour)
+            replay += time.perf_counter() - start
+            if tasks is None:
+                continue
+
+            start = time.perf_counter()
+            engineTools.newGame()
+            [engineTools.analysePosition(task, nodes) for task in tasks]
+            search += time.perf_counter() - start
+            positions += len(tasks)
+    finally:
+        engineTools.kill()
+
+    return {
+        'engine': engineTools.name(),
+        'nodes': nodes,
+        'threads': threads,
+        'hash': memory,
+        'positions': positions,
+        'positionsPerSecond': positions / (replay + search),
+        'nodesPerSecond': timer.nodesSearched / search,
+        'replay': replay,
+        'search': search,
+        'parsing': timer.parsing
+    }
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.WARNING, stream=sys.stdout)
+
+    with open(args.games) as f:
+        games = [Game.fromDict(g) for g in json.load(f)][:args.limit]
+
+    print(f"{'nodes':>9} {'threads':>7} {'hash':>6} {'positions':>9} {'pos/s':>8} {'nodes/s':>10} {'replay s':>9} {'search s':>9} {'parse s':>8}")
+    for nodes, threads, memory in itertools.product(args.nodes, args.threads, args.hash):
+        r = benchmark(games, nodes, threads, memory)
+        print(f"{r['nodes']:>9} {r['threads']:>7} {r['hash']:>6} {r['positions']:>9} {r['positionsPerSecond']:>8.2f} "
+            f"{r['nodesPerSecond']:>10.0f} {r['replay']:>9.2f} {r['search']:>9.2f} {r['parsing']:>8.2f}")
+    print(f"engine: {r['engine']}, {len(games)} games")
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,33 @@
 from default_imports import *
 
 import argparse
+import math
 import os
+import random
+import signal
 import sys
+import threading
 import time
 import json
 
 from conf.ConfigWrapper import ConfigWrapper
 
-from modules.game.Game import Game, GameDB
-from modules.game.AnalysedPosition import AnalysedPositionDB
+from modules.game.Game import Game, GameDB, GameID
+from modules.game.PositionMemo import PositionMemo
+from modules.game.NodeAllocation import NodeAllocation
 from modules.game.AnalysedGame import AnalysedGame
-from modules.game.EngineTools import EngineTools
 
 from modules.db.DBManager import DBManager
 
 from modules.client.Env import Env
 from modules.client.Api import Api
+from modules.client.Job import Job
+from modules.client.Prefetcher import Prefetcher
+from modules.client.EarlyStop import EarlyStop
+from modules.client.Autotune import Autotune
+from modules.client.Batch import Batch, BatchOutput
+
+from concurrent.futures import ThreadPoolExecutor, wait
 
 
 conf = ConfigWrapper.new(os.environ.get("IRWIN_CONFIG", "conf/client_config.json"))
@@ -25,6 +36,12 @@ parser = argparse.ArgumentParser(description=__doc__)
 ## Training
 parser.add_argument("--token", dest="token", nargs="?",
                 default=None, help="token to use with webserver")
+parser.add_argument("--input", dest="input", nargs="+",
+                default=None, help="analyse the games in these files of Game JSON offline, instead of requesting jobs")
+parser.add_argument("--output", dest="output", nargs="?",
+                default="analysedGames.jsonl", help="file to append AnalysedGame JSON lines to in offline mode. Games already in it are skipped")
+parser.add_argument("--autotune", dest="autotune", nargs="?",
+                default=False, const=True, help="benchmark engine settings on this host again and cache the fastest")
 
 loglevels = {
     'CRITICAL': logging.CRITICAL,
@@ -42,43 +59,367 @@ logging.getLogger("modules.fishnet.fishnet").setLevel(logging.WARNING)
 
 args = parser.parse_args()
 
+if args.autotune or conf['stockfish autotune']:
+    conf = Autotune.apply(conf, retune=args.autotune)
+
 env = Env(conf, token = args.token)
 api = Api(env)
 
-def analyseGames(games: List[Game], playerId: str) -> Iterable[AnalysedGame]:
+# on SIGTERM (deploys, scale-downs) or Ctrl-C, finish the games in progress and give back the job
+stopping = threading.Event()
+
+def stop(signum, frame):
+    logging.warning(f'Received signal {signum}. Stopping after the games in progress')
+    stopping.set()
+
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+
+# how far each job being analysed is, sent with heartbeats
+progress = {}
+
+def submitGame(analysedGame: AnalysedGame, activations: Opt[List[int]] = None) -> Opt[Dict]:
     """
-    Iterate through list of games and return analysed games
+    Stream one analysed game to the server. The server's answer if it was stored.
     """
+    response = api.submitGame(analysedGame, activations)
+    if response is not None and response.status_code == 200:
+        try:
+            return response.json()
+        except json.decoder.JSONDecodeError:
+            return {}
+    logging.warning(f'Failed to submit {analysedGame.id}. It will be sent when the job is finalized')
+    return None
 
+def publish(analysedGame: AnalysedGame, submitted: set, activations: Opt[List[int]] = None) -> Opt[Dict]:
+    """
+    Journal a final analysed game and, when streaming, submit it, adding its ID to `submitted`.
+    With `activations` the server is asked for the running activation, and they are
+    replaced with the activations it answers with.
+    """
+    if env.journal is not None:
+        env.journal.write(analysedGame)
+    if conf['client stream']:
+        response = submitGame(analysedGame, activations)
+        if response is not None:
+            submitted.add(analysedGame.gameId)
+            if activations is not None and 'activations' in response:
+                activations[:] = response['activations']
+        return response
+    return None
+
+def analyseGames(games: List[Game], playerId: str, nodes: int, memo: PositionMemo, submitted: set, final: bool = True, earlyStop: Opt[EarlyStop] = None, allocation: Opt[NodeAllocation] = None) -> Iterable[AnalysedGame]:
+    """
+    Analyse a list of games across the engine pool and return the analysed games.
+    Games are analysed in groups that share an opening, each group on one engine.
+    Positions already in `memo` are not searched again; new searches are added to it.
+    Final analyses are queued for publishing on the uploader as soon as they are done,
+    so engines go on to their next game while they are submitted.
+    With `earlyStop` games are analysed in the order given, one per engine at a time,
+    until the player's running activation is settled. With an `allocation` positions
+    get the nodes allocated to them rather than `nodes`.
+    """
     count = len(games)
-    for i, game in enumerate(games):
-        logging.warning(f'{playerId}: Analysing Game #{i+1} / {count}: {game.id}')
-        analysedGame = env.engineTools.analyseGame(game, game.white == playerId, conf['stockfish nodes'])
-        if analysedGame is not None:
-            yield analysedGame
+    done = []
+    publishing = [] # futures of publish, answered with the running activation when reported
+    activations = None if earlyStop is None else [] # of the games submitted so far, sent with the next
 
-while True:
-    logging.info('getting new job')
-    job = api.requestJob()
+    def record(game: Game, analysedGame: Opt[AnalysedGame]):
+        done.append(game.id)
+        progress[playerId] = {'analysed': len(done), 'games': count, 'shallow': not final}
+        logging.warning(f'{playerId}: Analysed Game #{len(done)} / {count}: {game.id}' + ('' if final else ' (shallow)'))
+        if analysedGame is not None and final:
+            publishing.append(uploader.submit(publish, analysedGame, submitted, activations))
 
-    if job is not None:
-        logging.warning(f'Analysing Player: {job.playerId}')
-        gameIds = [g.id for g in job.games]
-        logging.warning(f'Analysing Games: {gameIds}')
+    def settled() -> bool:
+        if earlyStop is None or len(publishing) == 0:
+            return False
+        wait(publishing)
+        reports = [f.result() for f in publishing if f.exception() is None]
+        reports = [r for r in reports if r is not None and 'activation' in r]
+        if len(reports) == 0:
+            return False
+        report = max(reports, key=lambda r: r['games'])
+        if earlyStop.stop(report['games'], report['activation']):
+            logging.warning(f"{playerId}: Activation {report['activation']}% over {report['games']} games is settled. "
+                f"Skipping {count - len(done)} games")
+            return True
+        return False
 
-        analysedGames = list(analyseGames(job.games, job.playerId))
+    if conf['stockfish shard']:
+        # games are taken one at a time and each game's positions are spread over the pool
+        ordered = games if earlyStop is not None else sorted(games, key=lambda g: g.pgn)
+        for i, game in enumerate(ordered):
+            if settled() or stopping.is_set():
+                return
+            logging.warning(f'{playerId}: Analysing Game #{i+1} / {count}: {game.id}')
+            analysedGame = env.enginePool.shardGame(game, game.white == playerId, nodes, memo, allocation)
+            record(game, analysedGame)
+            if analysedGame is not None:
+                yield analysedGame
+        return
 
-        response = api.completeJob(job, analysedGames)
+    if earlyStop is None:
+        groups = Game.openingGroups(games, conf['client trie_plies'], math.ceil(count / env.enginePool.size()))
+        step = len(groups)
+    else:
+        groups = [[g] for g in games]
+        step = env.enginePool.size()
+    analyseGroup = lambda group: env.enginePool.analyseGroup([(g, g.white == playerId) for g in group], nodes, memo, record, allocation, stopping)
+    for i in range(0, len(groups), max(step, 1)):
+        if settled() or stopping.is_set():
+            return
+        for analysedGames in env.enginePool.map(analyseGroup, groups[i:i+step]):
+            yield from (ag for ag in analysedGames if ag is not None)
+
+def triage(games: List[Game], playerId: str, submitted: set) -> Tuple[List[Game], Dict[GameID, AnalysedGame]]:
+    """
+    Pipeline mode: analyse `games` at the shallow node budget and have the server rank
+    them with the analysed game model. Returns the games to analyse deeply -- those at or
+    above the activation threshold, those the model could not predict and a random
+    control sample of the rest -- and the shallow analyses that stand in for the others.
+    """
+    shallowGames = list(analyseGames(games, playerId, conf['client pipeline_nodes'], PositionMemo.new(), submitted, final=False))
+    activations = api.rankGames(playerId, shallowGames)
+    if activations is None:
+        logging.warning(f'{playerId}: Failed to rank shallow analyses. Analysing every game deeply')
+        return games, {}
+
+    threshold = conf['client pipeline_threshold']
+    flagged = [g for g in games if activations.get(g.id) is None or activations[g.id] >= threshold]
+    control = [g for g in games if g not in flagged and random.random() < conf['client pipeline_control']]
+    deepIds = {g.id for g in flagged + control}
+    logging.warning(f'{playerId}: Analysing {len(flagged)} flagged and {len(control)} control games deeply, '
+        f'keeping {len(games) - len(deepIds)} shallow analyses')
+
+    # the shallow analyses that are kept are final, marked so they are not trained on
+    shallowGames = {ag.gameId: ag._replace(shallow=True) for ag in shallowGames if ag.gameId not in deepIds}
+    [uploader.submit(publish, ag, submitted) for ag in shallowGames.values()]
+    return [g for g in games if g.id in deepIds], shallowGames
+
+def uploadJob(job: Job, analysedGames: List[AnalysedGame], submitted: set):
+    """
+    Post a finished job to the server, then release it so it is no longer
+    excluded from job requests. Runs on the uploader thread.
+    """
+    try:
+        if conf['client stream']:
+            response = api.finalizeJob(job, [ag for ag in analysedGames if ag.gameId not in submitted])
+        else:
+            response = api.completeJob(job, analysedGames)
 
         if response is not None:
             try:
                 resJson = response.json()
                 if response.status_code == 200:
                     logging.info('SUCCESS. Posted completed job. Message: {}'.format(resJson.get('message')))
+                    if env.journal is not None:
+                        env.journal.clear(job.playerId)
                 else:
                     logging.warning('SOFT FAILURE. Failed to post completed job. Message: {}'.format(resJson.get('message')))
             except json.decoder.JSONDecodeError:
                 logging.warning(f'HARD FAILURE. Failed to post job. Bad response from server.')
+    except Exception:
+        logging.exception(f'Failed to upload job for {job.playerId}')
+    finally:
+        progress.pop(job.playerId, None)
+        prefetcher.release(job.playerId)
+
+def releaseJob(job: Job, analysedGames: List[AnalysedGame], submitted: set):
+    """
+    Give back a job left unfinished at shutdown, so another client can take it up.
+    Analysed games that were not streamed are submitted first; the server only hands
+    out the games it has no analysis for. Runs on the uploader thread, after the
+    job's streamed games.
+    """
+    stored = [submitGame(ag) is not None for ag in analysedGames if ag.gameId not in submitted]
+    response = api.releaseJob(job.playerId)
+    if response is not None and response.status_code == 200:
+        logging.warning(f'Released {job.playerId} with {len(analysedGames)} of {len(job.games)} games analysed')
+        if all(stored) and env.journal is not None:
+            env.journal.clear(job.playerId)
     else:
-        logging.warning('Job is None. Pausing')
-        time.sleep(10)
+        logging.warning(f'Failed to release {job.playerId}. It stays leased to this client')
+    progress.pop(job.playerId, None)
+    prefetcher.release(job.playerId)
+
+def analyseBatch(inputs: List[str], output: str):
+    """
+    Offline mode: analyse the games in `inputs` over the whole engine pool and append
+    them to `output`, skipping games already there. Games are taken in chunks sorted
+    by opening, so each chunk's groups share positions and its memo stays small.
+    """
+    batch = Batch.read(inputs)
+    batchOutput = BatchOutput.new(output)
+    remaining = sorted(batch.remaining(batchOutput.done), key=lambda gc: gc[0].pgn)
+    count = len(remaining)
+    logging.warning(f'Batch: {len(batch.games)} games to analyse, {len(batch.games) - count} already in {output}')
+
+    nodes = conf['stockfish nodes']
+    size = env.enginePool.size()
+    done, failed = [], []
+    start = time.time()
+
+    def record(game: Game, analysedGame: Opt[AnalysedGame]):
+        done.append(game.id)
+        if analysedGame is None:
+            failed.append(game.id)
+        else:
+            batchOutput.write(analysedGame)
+        elapsed = time.time() - start
+        rate = len(done) / elapsed
+        logging.warning(f'Batch: {len(done)} / {count} games, {60*rate:.1f} games/min, '
+            f'{env.enginePool.stats().get("nodesRequested") / elapsed:.0f} nodes/s, {(count - len(done)) / rate / 60:.0f} min left')
+
+    chunk = 25 * size
+    for i in range(0, count, chunk):
+        if stopping.is_set():
+            break
+        games = remaining[i:i+chunk]
+        colours = {}
+        [colours.setdefault(game.id, []).append(colour) for game, colour in games]
+        memo = PositionMemo.new()
+        groups = Game.openingGroups(list({game.id: game for game, _ in games}.values()), conf['client trie_plies'], math.ceil(len(colours) / size))
+        analyseGroup = lambda group: env.enginePool.analyseGroup([(g, c) for g in group for c in colours[g.id]], nodes, memo, record, stop=stopping)
+        list(env.enginePool.map(analyseGroup, groups))
+
+    logging.warning(f'Batch: analysed {len(done) - len(failed)} games into {output} in {time.time() - start:.0f}s, {len(failed)} could not be analysed')
+    logging.warning(env.enginePool.stats().summary())
+
+if args.input:
+    analyseBatch(args.input, args.output)
+    sys.exit(0)
+
+# the next job is leased while these are analysed, and each is uploaded while the next ones are analysed.
+# The uploader runs one task at a time in order, so a job's streamed games are submitted before it is finalized
+prefetcher = Prefetcher(api, conf['client prefetch'])
+uploader = ThreadPoolExecutor(max_workers=1)
+earlyStop = EarlyStop.new(conf)
+nodesPerSecond = conf['client deadline_nps'] # measured while the pool is busy, to fit jobs with a target time
+
+def heartbeat():
+    """
+    Keep the leases on every job this client holds, so the server does not hand
+    them to another client, until the client stops
+    """
+    lost = set()
+    while not stopping.wait(conf['client heartbeat_seconds']):
+        held = [playerId for playerId in prefetcher.holding() if playerId not in lost]
+        if len(held) == 0:
+            continue
+        leases = api.heartbeat({playerId: progress.get(playerId, {}) for playerId in held})
+        if leases is None:
+            logging.warning(f'Heartbeat for {held} failed')
+            continue
+        for playerId, leased in leases.items():
+            if not leased:
+                logging.warning(f'Lost the lease on {playerId}. Another client may analyse it too')
+                lost.add(playerId)
+
+if conf['client heartbeat_seconds'] > 0:
+    threading.Thread(target=heartbeat, name='heartbeat', daemon=True).start()
+
+def allocate(job: Job, games: List[Game]) -> Opt[NodeAllocation]:
+    """
+    Nodes per position to finish `games` within the job's target time, if it has one
+    """
+    if job.targetSeconds is None:
+        return None
+    allocation = NodeAllocation.new(conf, [(g, g.white == job.playerId) for g in games], conf['stockfish nodes'], job.targetSeconds, nodesPerSecond)
+    if allocation is not None:
+        positions = list(allocation.positions.values())
+        logging.warning(f'{job.playerId}: Fitting {len(positions)} positions into {job.targetSeconds}s at {nodesPerSecond:.0f} nodes/s: '
+            f'{sum(n == allocation.nodes for n in positions)} at full depth, mean {sum(positions) // len(positions)} nodes')
+    return allocation
+
+# Jobs analysed at once. A job's groups are queued on the pool behind those of the jobs started
+# before it, so the next job takes the engines the current one leaves idle at its tail
+analysing = threading.Semaphore(conf['client jobs'])
+runner = ThreadPoolExecutor(max_workers=conf['client jobs'])
+statsLock = threading.Lock()
+active = 0 # jobs being analysed
+statsSince = time.time() # since when the pool's stats were gathered, while busy
+
+def analyseJob(job: Job):
+    """
+    Analyse a leased job and hand it to the uploader. Runs on the runner, beside
+    up to `client jobs` - 1 other jobs.
+    """
+    global active, statsSince
+    with statsLock:
+        if active == 0:
+            # nodes/s are measured over the time the pool is busy
+            env.enginePool.stats().reset()
+            statsSince = time.time()
+        active += 1
+    try:
+        logging.warning(f'Analysing Player: {job.playerId}')
+        gameIds = [g.id for g in job.games]
+        logging.warning(f'Analysing Games: {gameIds}')
+
+        memo = PositionMemo.new(job.analysedPositions)
+        logging.warning(f'Received {len(memo.servedIds)} cached positions')
+
+        # resume from the journal if we were interrupted part way through this job
+        journaled = {} if env.journal is None else {ag.gameId: ag for ag in env.journal.read(job.playerId)}
+        remainingGames = [g for g in job.games if g.id not in journaled]
+        if len(remainingGames) < len(job.games):
+            logging.warning(f'Resuming {job.playerId}: {len(job.games) - len(remainingGames)} games already analysed')
+
+        submitted = set()
+        shallowGames = {}
+        if conf['client pipeline'] and not job.deep and len(remainingGames) > 0:
+            remainingGames, shallowGames = triage(remainingGames, job.playerId, submitted)
+        analysedGames = {ag.gameId: ag for ag in analyseGames(remainingGames, job.playerId, conf['stockfish nodes'], memo, submitted,
+            earlyStop=earlyStop, allocation=allocate(job, remainingGames))}
+        analysedGames = {**shallowGames, **journaled, **analysedGames}
+        analysedGames = [analysedGames.get(g.id) for g in job.games]
+        analysedGames = [ag for ag in analysedGames if ag is not None]
+
+        if stopping.is_set() and len(analysedGames) < len(job.games):
+            uploader.submit(releaseJob, job, analysedGames, submitted)
+        else:
+            # send back only what we searched ourselves, for the server to cache
+            uploader.submit(uploadJob, job._replace(analysedPositions=memo.newPositions()), analysedGames, submitted)
+    except Exception:
+        logging.exception(f'Failed to analyse {job.playerId}. Releasing it')
+        uploader.submit(releaseJob, job, [], set())
+    finally:
+        jobDone()
+        analysing.release()
+
+def jobDone():
+    """
+    Measure the pool's nodes per second over the time it was busy, and log its stats
+    """
+    global active, statsSince, nodesPerSecond
+    with statsLock:
+        active -= 1
+        elapsed, nodesRequested = time.time() - statsSince, env.enginePool.stats().get('nodesRequested')
+        if elapsed > 0 and nodesRequested > 0:
+            nodesPerSecond = (nodesPerSecond + nodesRequested / elapsed) / 2
+        logging.warning(env.enginePool.stats().summary())
+        env.enginePool.stats().reset()
+        statsSince = time.time()
+        if env.positionCache is not None:
+            logging.warning(env.positionCache.stats())
+
+while not stopping.is_set():
+    # only take a job when it can be started
+    if not analysing.acquire(timeout=1):
+        continue
+    logging.info('getting new job')
+    job = prefetcher.next(stopping)
+
+    if job is not None:
+        runner.submit(analyseJob, job)
+    else:
+        analysing.release()
+        if not stopping.is_set():
+            logging.warning('Job is None. Pausing')
+            stopping.wait(10)
+
+runner.shutdown(wait=True)
+prefetcher.close()
+uploader.shutdown(wait=True)
+logging.warning('Stopped')
@@ -12,14 +12,46 @@ class ApiSettings(BaseSettings):
     token: str = ""
 
 
+class StockfishBudgetSettings(BaseSettings):
+    """Adaptive node budget settings. Used by: deep-queue"""
+    model_config = SettingsConfigDict(env_prefix='IRWIN_STOCKFISH_BUDGET_')
+    adaptive: bool = False  # Stop searches early once settled, extend close ones
+    stable_iterations: int = 4  # Stop after this many iterations with the same MultiPV order and scores
+    stable_cp: int = 10  # Score change (cp) still counted as stable
+    min_fraction: float = 0.2  # Never stop before this fraction of the node budget
+    few_moves: int = 2  # Positions with at most this many legal moves are capped
+    forced_fraction: float = 0.1  # Node budget fraction for positions with few legal moves
+    lopsided_cp: int = 500  # Evals beyond this (or mates) are capped
+    lopsided_fraction: float = 0.3  # Node budget fraction for lopsided positions
+    close_cp: int = 20  # Top two moves within this many cp after the budget get a second search
+    close_factor: float = 2.0  # Node budget multiple close positions search in all
+
+
 class StockfishSettings(BaseSettings):
     """Stockfish engine settings. Used by: deep-queue"""
     model_config = SettingsConfigDict(env_prefix='IRWIN_STOCKFISH_')
+    engines: int = 1
+    driver: str = "uci"  # "uci" (python-chess, threads per engine) or "async" (all engines on one event loop)
+    shard: bool = False  # spread the positions of each game over all engines
     threads: int = 4
     memory: int = 2048
     nodes: int = 4500000
+    reuse_pv: bool = False  # Take the played move's eval from the MultiPV search when it is one of the PVs
+    reuse_pv_audit: float = 0.0  # Fraction of reusable moves searched anyway, to compare the two evals
+    game_evals: bool = False  # Take the played move's eval from lichess's analysis of the game when it has one
+    affinity: bool = False  # Pin each engine's threads to CPUs of its own
+    autotune: bool = False  # Pick engines, threads and memory by benchmarking the host on first start (cached in autotune_cache)
+    autotune_cache: str = "autotune.json"  # Where the tuned settings are kept
+    autotune_nodes: int = 200000  # Nodes per position searched while tuning
+    autotune_positions: int = 64  # Positions each engine searches for each candidate setting
+    autotune_seconds: float = 10.0  # Each candidate setting is measured for at least this long
+    watchdog_nps: int = 50000  # Slowest expected nodes per second per thread; slower searches count as hung
+    watchdog_grace: float = 30.0  # Seconds added to every search deadline
+    watchdog_retries: int = 2  # Times a position is retried on a restarted engine before its game is dropped
+    watchdog_standby: bool = True  # Keep a started engine ready to replace a failed one
     update: bool = False
     path: str = ""  # If set, use this path instead of auto-detecting
+    budget: StockfishBudgetSettings = Field(default_factory=StockfishBudgetSettings)
 
 
 class DbAuthSettings(BaseSettings):
@@ -48,6 +80,11 @@ class QueueCollSettings(BaseSettings):
 
 class QueueSettings(BaseSettings):
     """Queue settings. Used by: webapp, lichess-listener"""
+    model_config = SettingsConfigDict(env_prefix='IRWIN_QUEUE_')
+    moderator_seconds: int = 0  # Time in which clients should finish jobs a moderator asked for, at reduced depth if need be (0 for full depth)
+    max_jobs: int = 8  # Most jobs a client may lease in one request
+    lease_seconds: int = 900  # A leased job goes back in the queue if its client sends no heartbeat for this long
+    reclaim_seconds: int = 60  # Seconds between sweeps for expired leases
     coll: QueueCollSettings = Field(default_factory=QueueCollSettings)
 
 
@@ -88,6 +125,36 @@ class AuthSettings(BaseSettings):
     coll: AuthCollSettings = Field(default_factory=AuthCollSettings)
 
 
+class ClientCacheSettings(BaseSettings):
+    """Local position cache settings. Used by: deep-queue"""
+    model_config = SettingsConfigDict(env_prefix='IRWIN_CLIENT_CACHE_')
+    path: str = ""  # If set, keep a persistent position cache in this sqlite file
+    size: int = 500000  # Maximum number of cached searches
+
+
+class ClientSettings(BaseSettings):
+    """Analysis client settings. Used by: deep-queue"""
+    model_config = SettingsConfigDict(env_prefix='IRWIN_CLIENT_')
+    journal: str = ""  # If set, journal analysed games in this directory so jobs can resume after a crash
+    stream: bool = True  # Submit each game as soon as it is analysed, then finalize the job
+    trie_plies: int = 8  # Games sharing their first this many plies run on one engine without clearing its hash (0 to clear before every game)
+    prefetch: int = 1  # Jobs to lease ahead while one is analysed (0 to request each job when the last is done)
+    jobs: int = 2  # Jobs analysed at once; the next job's groups take the engines the current one leaves idle at its tail
+    pipeline: bool = False  # Analyse every game shallowly first and deep-analyse only those the model ranks as suspicious
+    pipeline_nodes: int = 300000  # Nodes per position in the shallow pass
+    pipeline_threshold: int = 50  # Shallow game activation (0-100) from which a game is analysed deeply
+    pipeline_control: float = 0.1  # Fraction of the remaining games analysed deeply anyway, as a control sample
+    early_stop: bool = False  # Analyse a job's games most suspicious first and stop once the player's activation is settled (needs stream)
+    early_stop_games: int = 10  # Games the running activation must cover before a job may stop
+    early_stop_below: int = 40  # Stop when the running activation is below this
+    early_stop_above: int = 90  # Stop when the running activation is at least this
+    deadline_nps: int = 1000000  # Nodes per second the client assumes it searches, until it has measured itself on a job
+    deadline_min_nodes: int = 50000  # Fewest nodes a position gets when a job has a target time
+    heartbeat_seconds: int = 60  # Interval between heartbeats that keep the leases on held jobs (0 to send none); keep well below the server's queue lease_seconds
+    wire_format: str = "packed"  # Encoding of job and result payloads: packed (compressed columns, if the server supports it) or json
+    cache: ClientCacheSettings = Field(default_factory=ClientCacheSettings)
+
+
 class IrwinCollSettings(BaseSettings):
     """Irwin collection names. Used by: webapp, lichess-listener"""
     model_config = SettingsConfigDict(env_prefix='IRWIN_IRWIN_COLL_')
@@ -161,6 +228,7 @@ class Settings(BaseSettings):
     game: GameSettings = Field(default_factory=GameSettings)
     server: ServerSettings = Field(default_factory=ServerSettings)
     auth: AuthSettings = Field(default_factory=AuthSettings)
+    client: ClientSettings = Field(default_factory=ClientSettings)
     irwin: IrwinSettings = Field(default_factory=IrwinSettings)
     loglevel: str = "INFO"
 
@@ -215,12 +283,22 @@ def _set_by_path(d: Dict, path: list[str], value):
     d[path[-1]] = value
 
 
+def _has_path(d: Dict, path: list[str]) -> bool:
+    """Check whether a nested dict has a value at path."""
+    for key in path:
+        if not isinstance(d, dict) or key not in d:
+            return False
+        d = d[key]
+    return True
+
+
 def _merge_env_over_file(file_config: Dict, env_config: Dict, mappings: Dict[str, list[str]]) -> Dict:
-    """Merge env config over file config, but only for env vars that are actually set."""
+    """Merge env config over file config, but only for env vars that are actually set.
+    Settings missing from the file fall back to their defaults."""
     result = json.loads(json.dumps(file_config))
 
     for env_var, path in mappings.items():
-        if env_var in os.environ:
+        if env_var in os.environ or not _has_path(result, path):
             value = _get_by_path(env_config, path)
             _set_by_path(result, path, value)
 
@@ -69,7 +69,7 @@ def handleLine(payload: Dict):
             newEngineQueue = EngineQueue.merge(existingEngineQueue, newEngineQueue)
 
         requiredGames = env.gameApi.gamesForAnalysis(
-            playerId, newEngineQueue.requiredGameIds
+            playerId, newEngineQueue.requiredGameIds, analysis=False
         )
         if len(requiredGames) > 0:
             env.queue.queueEngineAnalysis(newEngineQueue)
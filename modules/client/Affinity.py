@@ -0,0 +1,44 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+import os
+
+class Affinity(NamedTuple('Affinity', [
+        ('cpus', List[int]),
+        ('threads', int)
+    ])):
+    """
+    Gives the engine in each pool slot its own `threads` CPUs, so engines do not
+    compete with each other for cores. Only available where the OS supports it.
+    """
+    @staticmethod
+    def new(conf: ConfigWrapper) -> Opt['Affinity']:
+        if not conf['stockfish affinity']:
+            return None
+        if not hasattr(os, 'sched_setaffinity'):
+            logging.warning('CPU affinity is not supported on this platform')
+            return None
+        return Affinity(
+            cpus=sorted(os.sched_getaffinity(0)),
+            threads=conf['stockfish threads'])
+
+    def slotCpus(self, slot: int) -> List[int]:
+        return [self.cpus[(slot*self.threads + i) % len(self.cpus)] for i in range(self.threads)]
+
+    def pin(self, slot: int, pid: int):
+        """
+        Pin every thread of process `pid`. Stockfish's search threads already exist
+        once its options are set, and would not inherit a mask set on the process alone.
+        """
+        cpus = self.slotCpus(slot)
+        try:
+            tids = [int(t) for t in os.listdir(f'/proc/{pid}/task')]
+        except OSError:
+            tids = [pid]
+        for tid in tids:
+            try:
+                os.sched_setaffinity(tid, cpus)
+            except OSError as e:
+                logging.warning(f'Failed to pin engine {slot} to CPUs {cpus}: {e!r}')
+                return
@@ -4,37 +4,140 @@ import json
 import requests
 import time
 
-from modules.game.Game import GameBSONHandler
+from modules.game.Game import GameBSONHandler, GameID
+from modules.game.Player import PlayerID
 from modules.game.AnalysedGame import AnalysedGameBSONHandler, AnalysedGame
 from modules.client.Env import Env
 from modules.client.Job import Job
+from modules.client.Wire import Wire
 
 from requests.models import Response
 
 class Api(NamedTuple('Api', [
         ('env', Env)
     ])):
-    def requestJob(self) -> Opt[Dict]:
+    def requestJob(self, exclude: List[PlayerID] = []) -> Opt[Job]:
+        """
+        Lease a job. Players in `exclude` are jobs this client already holds.
+        """
+        jobs = self.requestJobs(exclude, 1)
+        return jobs[0] if len(jobs) > 0 else None
+
+    def requestJobs(self, exclude: List[PlayerID] = [], count: int = 1) -> List[Job]:
+        """
+        Lease up to `count` jobs in one request. The server may lease fewer.
+        """
         for i in range(5):
             try:
-                result = requests.get(f'{self.env.url}/api/request_job', json={'auth': self.env.auth})
-                return Job.fromJson(result.json())
-            except (json.decoder.JSONDecodeError, requests.ConnectionError, requests.exceptions.SSLError) as e:
+                result = requests.get(f'{self.env.url}/api/request_job', json={
+                    'auth': self.env.auth,
+                    'count': count,
+                    'nodes': self.env.config['stockfish nodes'],
+                    'engine': self.env.enginePool.engineName(),
+                    'exclude': exclude,
+                    'gameEvals': self.env.config['stockfish game_evals'],
+                    'rank': self.env.config['client early_stop'],
+                    'heartbeat': self.env.config['client heartbeat_seconds'] > 0,
+                    'encodings': [Wire.packed] if self.env.config['client wire_format'] == Wire.packed else []})
+                body = result.json()
+                if Wire.isPacked(body):
+                    # the server reads packed payloads, so results go back packed too
+                    self.env.packed = True
+                    body = Wire.unpack(body)
+                    body = body['jobs'] if 'jobs' in body else [body['job']]
+                elif 'jobs' in body:
+                    body = body['jobs']
+                else:
+                    body = [body] # a server that leases one job at a time
+                jobs = [Job.fromJson(j) for j in body]
+                return [job for job in jobs if job is not None]
+            except (ValueError, KeyError, requests.ConnectionError, requests.exceptions.SSLError) as e:
                 logging.warning(f"Error in request job. Trying again in 10 sec. Error: {e}")
                 time.sleep(10)
-        return None
+        return []
 
     def completeJob(self, job: Job, analysedGames: List[AnalysedGame]) -> Opt[Response]:
-        payload = {
+        return self.post('complete_job', {
             'auth': self.env.auth,
             'job': job.toJson(),
-            'analysedGames': [ag.toJson() for ag in analysedGames] 
-        }
+            'analysedGames': [ag.toJson() for ag in analysedGames]
+        })
+
+    def submitGame(self, analysedGame: AnalysedGame, activations: Opt[List[int]] = None) -> Opt[Response]:
+        """
+        Store one analysed game. With the `activations` of the job's games submitted
+        before it, the server also answers with the running `activation`, the number
+        of `games` it covers and their `activations`, this game's included.
+        """
+        return self.post('submit_game', {
+            'auth': self.env.auth,
+            'playerId': analysedGame.playerId,
+            'analysedGame': analysedGame.toJson(),
+            'report': activations is not None,
+            'activations': [] if activations is None else activations
+        })
+
+    def rankGames(self, playerId: PlayerID, analysedGames: List[AnalysedGame]) -> Opt[Dict[GameID, Opt[int]]]:
+        """
+        Activations of the analysed game model for shallow analyses of a leased job's games.
+        None for a game the model could not predict; None altogether if the server did not answer.
+        """
+        response = self.post('rank_games', {
+            'auth': self.env.auth,
+            'playerId': playerId,
+            'analysedGames': [ag.toJson() for ag in analysedGames]
+        })
+        if response is None or response.status_code != 200:
+            return None
+        try:
+            return response.json()['activations']
+        except (json.decoder.JSONDecodeError, KeyError):
+            return None
+
+    def finalizeJob(self, job: Job, analysedGames: List[AnalysedGame] = []) -> Opt[Response]:
+        """
+        Close a job whose games were submitted one at a time. `analysedGames` are
+        any games that could not be submitted.
+        """
+        return self.post('finalize_job', {
+            'auth': self.env.auth,
+            'job': job.toJson(),
+            'analysedGames': [ag.toJson() for ag in analysedGames]
+        })
+
+    def releaseJob(self, playerId: PlayerID) -> Opt[Response]:
+        """
+        Give back a leased job this client will not finish
+        """
+        return self.post('release_job', {
+            'auth': self.env.auth,
+            'playerId': playerId
+        })
+
+    def heartbeat(self, progress: Dict[PlayerID, Dict]) -> Opt[Dict[PlayerID, bool]]:
+        """
+        Keep the leases on the jobs in `progress`, which maps each player to how far
+        this client is with their job. Whether each lease is still held; None if the
+        server did not answer.
+        """
+        response = self.post('heartbeat', {
+            'auth': self.env.auth,
+            'progress': progress
+        })
+        if response is None or response.status_code != 200:
+            return None
+        try:
+            return response.json()['leases']
+        except (json.decoder.JSONDecodeError, KeyError):
+            return None
+
+    def post(self, route: str, payload: Dict) -> Opt[Response]:
+        payload = Wire.pack(payload) if self.env.packed else payload
         for i in range(5):
             try:
-                result = requests.post(f'{self.env.url}/api/complete_job', json=payload)
+                result = requests.post(f'{self.env.url}/api/{route}', json=payload)
                 return result
             except (json.decoder.JSONDecodeError, requests.ConnectionError, requests.exceptions.SSLError):
-                logging.warning('Error in completing job. Trying again in 10 sec')
+                logging.warning(f'Error in {route}. Trying again in 10 sec')
                 time.sleep(10)
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,159 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+from modules.game.Game import Game
+from modules.game.Colour import Colour
+from modules.game.AnalysedGame import AnalysedGame
+from modules.game.AnalysedMove import AnalysedMove
+from modules.game.EngineTools import EngineTools, PositionTask
+from modules.game.AsyncEngineTools import AsyncEngineTools
+from modules.game.PositionCache import PositionCache
+from modules.game.PositionMemo import PositionMemo
+from modules.game.NodeAllocation import NodeAllocation
+from modules.game.EngineStats import EngineStats
+
+from modules.client.EngineSupervisor import AsyncEngineSupervisor
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import asyncio
+import threading
+
+class AsyncEnginePool(NamedTuple('AsyncEnginePool', [
+        ('engines', List[AsyncEngineTools]),
+        ('idle', asyncio.Queue),
+        ('loop', asyncio.AbstractEventLoop),
+        ('executor', ThreadPoolExecutor),
+        ('supervisor', AsyncEngineSupervisor)
+    ])):
+    """
+    EnginePool with the same interface, driving every stockfish process from
+    one event loop running in a background thread.
+    """
+    @staticmethod
+    def new(conf: ConfigWrapper, positionCache: Opt[PositionCache] = None, stats: Opt[EngineStats] = None):
+        size = max(1, conf['stockfish engines'])
+        stats = EngineStats() if stats is None else stats
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name='engine-loop', daemon=True).start()
+
+        async def start():
+            engines = await asyncio.gather(*[AsyncEngineTools.new(conf, positionCache, stats) for _ in range(size)])
+            idle = asyncio.Queue()
+            [idle.put_nowait(slot) for slot in range(size)]
+            return list(engines), idle, AsyncEngineSupervisor(conf, positionCache, stats)
+
+        engines, idle, supervisor = asyncio.run_coroutine_threadsafe(start(), loop).result()
+        [supervisor.pin(slot, engineTools) for slot, engineTools in enumerate(engines)]
+
+        logging.warning(f'Started {size} async engines with {conf["stockfish threads"]} threads each')
+
+        return AsyncEnginePool(
+            engines=engines,
+            idle=idle,
+            loop=loop,
+            executor=ThreadPoolExecutor(max_workers=size),
+            supervisor=supervisor)
+
+    def size(self) -> int:
+        return len(self.engines)
+
+    def stats(self) -> EngineStats:
+        return self.engines[0].stats
+
+    def engineName(self) -> str:
+        return self.engines[0].searcher()
+
+    def run(self, coroutine):
+        """
+        Run a coroutine on the engine loop and wait for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def borrow(self, f):
+        """
+        Await `f` under the supervisor with whichever engine is idle first
+        """
+        slot = await self.idle.get()
+        try:
+            return await self.supervisor.run(self.engines, slot, f)
+        finally:
+            self.idle.put_nowait(slot)
+
+    def analyseGame(self, game: Game, colour: Colour, nodes: int, memo: Opt[PositionMemo] = None) -> Opt[AnalysedGame]:
+        return self.analyseGroup([(game, colour)], nodes, memo)[0]
+
+    def analyseGroup(self, games: List[Tuple[Game, Colour]], nodes: int, memo: Opt[PositionMemo] = None, onGame: Opt[Callable[[Game, Opt[AnalysedGame]], None]] = None, allocation: Opt[NodeAllocation] = None, stop: Opt[threading.Event] = None) -> List[Opt[AnalysedGame]]:
+        """
+        See EnginePool.analyseGroup. `onGame` runs off the engine loop.
+        """
+        async def analyseGames():
+            slot = await self.idle.get()
+            try:
+                analysedGames = []
+                for i, (game, colour) in enumerate(games):
+                    if stop is not None and stop.is_set():
+                        break
+                    analysedGame = await self.analyseOn(slot, game, colour, nodes, memo, newGame=(i == 0), allocation=allocation)
+                    if onGame is not None:
+                        await self.loop.run_in_executor(None, onGame, game, analysedGame)
+                    analysedGames.append(analysedGame)
+                return analysedGames
+            finally:
+                self.idle.put_nowait(slot)
+
+        return self.run(analyseGames())
+
+    async def analyseOn(self, slot: int, game: Game, colour: Colour, nodes: int, memo: Opt[PositionMemo], newGame: bool, allocation: Opt[NodeAllocation] = None) -> Opt[AnalysedGame]:
+        """
+        See EnginePool.analyseOn
+        """
+        tasks = EngineTools.positionTasks(game, colour)
+        if tasks is None:
+            return None
+
+        try:
+            if newGame:
+                await self.supervisor.run(self.engines, slot, lambda e: e.newGame())
+            analysedMoves = [await self.supervisor.run(self.engines, slot, lambda e: e.analysePosition(task, NodeAllocation.nodesFor(allocation, nodes, game.id, task), memo)) for task in tasks]
+        except AsyncEngineSupervisor.failures:
+            logging.error(f'Giving up on {game.id} after repeated engine failures')
+            return None
+
+        return EngineTools.analysedGame(game, colour, analysedMoves, NodeAllocation.meanNodes(allocation, nodes, game.id, tasks))
+
+    def analysePosition(self, task: PositionTask, nodes: int, memo: Opt[PositionMemo] = None) -> AnalysedMove:
+        return self.run(self.borrow(lambda e: e.analysePosition(task, nodes, memo)))
+
+    def shardGame(self, game: Game, colour: Colour, nodes: int, memo: Opt[PositionMemo] = None, allocation: Opt[NodeAllocation] = None) -> Opt[AnalysedGame]:
+        tasks = EngineTools.positionTasks(game, colour)
+        if tasks is None:
+            return None
+
+        async def analysePositions():
+            return await asyncio.gather(*[
+                self.borrow(lambda e, task=task: e.analysePosition(task, NodeAllocation.nodesFor(allocation, nodes, game.id, task), memo)) for task in tasks])
+
+        return self.gather(game, colour, analysePositions(), NodeAllocation.meanNodes(allocation, nodes, game.id, tasks))
+
+    def gather(self, game: Game, colour: Colour, analysePositions, nodes: int) -> Opt[AnalysedGame]:
+        """
+        Run `analysePositions` and put its AnalysedMoves together into the game,
+        searched at `nodes` per position on average
+        """
+        try:
+            analysedMoves = self.run(analysePositions)
+        except AsyncEngineSupervisor.failures:
+            logging.error(f'Giving up on {game.id} after repeated engine failures')
+            return None
+        return EngineTools.analysedGame(game, colour, analysedMoves, nodes)
+
+    def map(self, f, *iterables) -> Iterable:
+        """
+        Run `f` concurrently, one worker per engine. Workers only wait on the
+        engine loop; none of them read engine output.
+        """
+        return self.executor.map(f, *iterables)
@@ -0,0 +1,152 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+from modules.game.Game import Game
+from modules.game.EngineTools import EngineTools, PositionTask
+
+from modules.client.Affinity import Affinity
+
+from concurrent.futures import ThreadPoolExecutor
+
+import itertools
+import json
+import os
+import platform
+import random
+import time
+
+class Autotune(NamedTuple('Autotune', [
+        ('engines', int),
+        ('threads', int),
+        ('memory', int),
+        ('positionsPerSecond', float)
+    ])):
+    """
+    The number of engines, threads per engine and hash per engine (MB) that search
+    the most positions per second on this host, measured on the benchmark games.
+    """
+    games = 'data/benchmarkGames.json'
+
+    @staticmethod
+    def apply(conf: ConfigWrapper, retune: bool = False) -> ConfigWrapper:
+        """
+        `conf` with the tuned stockfish settings and CPU affinity. The host is tuned
+        if it has no cached result yet, or if `retune`.
+        """
+        host = Autotune.host(conf)
+        autotune = None if retune else Autotune.read(conf['stockfish autotune_cache'], host)
+        if autotune is None:
+            autotune = Autotune.tune(conf)
+            Autotune.write(conf['stockfish autotune_cache'], host, autotune)
+        logging.warning(f'Autotuned: {autotune.engines} engines with {autotune.threads} threads and {autotune.memory}MB hash each '
+            f'({autotune.positionsPerSecond:.1f} positions/s)')
+        return Autotune.configure(conf, autotune.engines, autotune.threads, autotune.memory)
+
+    @staticmethod
+    def configure(conf: ConfigWrapper, engines: int, threads: int, memory: int) -> ConfigWrapper:
+        d = json.loads(json.dumps(conf.asdict()))
+        d['stockfish'].update({'engines': engines, 'threads': threads, 'memory': memory, 'affinity': True})
+        return ConfigWrapper(d)
+
+    @staticmethod
+    def hostCpus() -> List[int]:
+        return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+    @staticmethod
+    def hostMemory() -> int:
+        """
+        Physical memory of the host in MB
+        """
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+
+    @staticmethod
+    def host(conf: ConfigWrapper) -> Dict:
+        """
+        What a tuning depends on. A cached result is only used on a matching host.
+        """
+        return {
+            'machine': platform.machine(),
+            'cpus': len(Autotune.hostCpus()),
+            'memory': Autotune.hostMemory(),
+            'path': conf['stockfish path'],
+            'nodes': conf['stockfish autotune_nodes'],
+            'positions': conf['stockfish autotune_positions'],
+            'seconds': conf['stockfish autotune_seconds']}
+
+    @staticmethod
+    def candidates(cpus: int, memory: int) -> List[Tuple[int, int, int]]:
+        """
+        (engines, threads, hash) for every split of `cpus` into engines of a power of
+        two threads, with hash sizes that keep all engines within half of `memory` MB
+        """
+        threads = [2**i for i in range(cpus.bit_length()) if 2**i <= cpus]
+        return [(cpus // t, t, h) for t, h in itertools.product(threads, [64, 256, 1024]) if (cpus // t) * h <= memory // 2]
+
+    @staticmethod
+    def tune(conf: ConfigWrapper) -> 'Autotune':
+        with open(Autotune.games) as f:
+            games = [Game.fromDict(g) for g in json.load(f)]
+        tasks = [t for game, colour in itertools.product(games, [True, False]) for t in (EngineTools.positionTasks(game, colour) or [])]
+        random.Random(0).shuffle(tasks) # spread over the games, not just their openings
+
+        results = []
+        for engines, threads, memory in Autotune.candidates(len(Autotune.hostCpus()), Autotune.hostMemory()):
+            autotune = Autotune.measure(conf, engines, threads, memory, tasks)
+            logging.warning(f'Autotune: {engines} engines x {threads} threads, {memory}MB hash: {autotune.positionsPerSecond:.1f} positions/s')
+            results.append(autotune)
+        return max(results, key=lambda a: a.positionsPerSecond)
+
+    @staticmethod
+    def measure(conf: ConfigWrapper, engines: int, threads: int, memory: int, tasks: List[PositionTask]) -> 'Autotune':
+        """
+        Search `tasks` on `engines` pinned engines. Each engine searches its own run of
+        `stockfish autotune_positions` of them, and goes on until `stockfish autotune_seconds`
+        have passed, so every setting is measured on enough searches to compare.
+        """
+        conf = Autotune.configure(conf, engines, threads, memory)
+        nodes, count, seconds = conf['stockfish autotune_nodes'], conf['stockfish autotune_positions'], conf['stockfish autotune_seconds']
+        affinity = Affinity.new(conf)
+        pool = [EngineTools.new(conf) for _ in range(engines)]
+        try:
+            if affinity is not None:
+                [affinity.pin(slot, engineTools.pid()) for slot, engineTools in enumerate(pool)]
+
+            def run(slot: int) -> int:
+                offset = slot * count % len(tasks)
+                searched = 0
+                for task in itertools.cycle(tasks[offset:] + tasks[:offset]):
+                    if searched >= count and time.perf_counter() - start >= seconds:
+                        break
+                    if searched % len(tasks) == 0:
+                        pool[slot].newGame() # a position searched again must not come from the hash
+                    pool[slot].analysePosition(task, nodes)
+                    searched += 1
+                return searched
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=engines) as executor:
+                searched = sum(executor.map(run, range(engines)))
+            return Autotune(engines, threads, memory, searched / (time.perf_counter() - start))
+        finally:
+            [engineTools.kill() for engineTools in pool]
+
+    @staticmethod
+    def read(path: str, host: Dict) -> Opt['Autotune']:
+        try:
+            with open(path) as f:
+                d = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            return None
+        if d.get('host') != host:
+            logging.warning(f'{path} was tuned on a different host')
+            return None
+        return Autotune(d['engines'], d['threads'], d['memory'], d['positionsPerSecond'])
+
+    @staticmethod
+    def write(path: str, host: Dict, autotune: 'Autotune'):
+        try:
+            with open(path, 'w') as f:
+                json.dump({'host': host, **autotune._asdict()}, f, indent=2)
+        except OSError as e:
+            logging.warning(f'Failed to cache autotune result in {path}: {e!r}')
@@ -0,0 +1,94 @@
+from default_imports import *
+
+from modules.game.Game import Game, GameBSONHandler
+from modules.game.Colour import Colour
+from modules.game.AnalysedGame import AnalysedGame, AnalysedGameID
+
+from threading import Lock
+
+import json
+import os
+
+class Batch(NamedTuple('Batch', [
+        ('games', List[Tuple[Game, Colour]])
+    ])):
+    """
+    Games to analyse offline, read from files of Game JSON. A file holds one JSON
+    value or one per line; a value is a game, a list of values, or an exported job
+    ({'playerId': ..., 'games': [...]}). Games of a job are analysed from the
+    player's side and other games from both sides.
+    """
+    @staticmethod
+    def read(paths: List[str]) -> 'Batch':
+        games = []
+        for path in paths:
+            with open(path) as f:
+                text = f.read()
+            try:
+                values = [json.loads(text)]
+            except json.decoder.JSONDecodeError:
+                values = [json.loads(line) for line in text.splitlines() if line.strip()]
+            [games.extend(Batch.parse(value)) for value in values]
+
+        # a game listed twice is analysed once
+        return Batch(games=list({AnalysedGame.makeId(game.id, colour): (game, colour) for game, colour in games}.values()))
+
+    @staticmethod
+    def parse(value) -> List[Tuple[Game, Colour]]:
+        if isinstance(value, list):
+            return [gc for v in value for gc in Batch.parse(v)]
+        if 'games' in value:
+            games = [Batch.game(g) for g in value['games']]
+            return [(game, game.white == value['playerId']) for game in games]
+        game = Batch.game(value)
+        return [(game, True), (game, False)]
+
+    @staticmethod
+    def game(d: Dict) -> Game:
+        """
+        Games exported from lichess have an `id`, games from jobs and the database an `_id`
+        """
+        return Game.fromDict(d) if 'id' in d else GameBSONHandler.reads(d)
+
+    def remaining(self, done: set) -> List[Tuple[Game, Colour]]:
+        return [(game, colour) for game, colour in self.games if AnalysedGame.makeId(game.id, colour) not in done]
+
+class BatchOutput(NamedTuple('BatchOutput', [
+        ('path', str),
+        ('lock', Lock),
+        ('done', set)
+    ])):
+    """
+    AnalysedGame JSON lines, appended as games are analysed, ready to be bulk
+    loaded. `done` holds the IDs already in the file, so a run can resume.
+    """
+    @staticmethod
+    def new(path: str) -> 'BatchOutput':
+        done = set()
+        lines = []
+        damaged = False
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        done.add(json.loads(line)['_id'])
+                        lines.append(line if line.endswith('\n') else line + '\n')
+                        damaged = damaged or not line.endswith('\n')
+                    except (json.decoder.JSONDecodeError, KeyError):
+                        damaged = True
+        if damaged:
+            # a line cut short by a crash would break the bulk load, and the next entry would be appended onto it
+            logging.warning(f'Dropping damaged lines from {path}')
+            with open(path + '.tmp', 'w') as f:
+                f.writelines(lines)
+            os.replace(path + '.tmp', path)
+        return BatchOutput(path=path, lock=Lock(), done=done)
+
+    def write(self, analysedGame: AnalysedGame):
+        line = json.dumps(analysedGame.toJson())
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.done.add(analysedGame.id)
@@ -0,0 +1,32 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+class EarlyStop(NamedTuple('EarlyStop', [
+        ('minGames', int),
+        ('below', int),
+        ('above', int)
+    ])):
+    """
+    Stopping rule for a job whose games are analysed most suspicious first. The server
+    answers each submitted game with the running activation over the job's games so
+    far; once it covers enough games and is clear of the report thresholds, the rest
+    of the job is skipped.
+    """
+    @staticmethod
+    def new(conf: ConfigWrapper) -> Opt['EarlyStop']:
+        if not conf['client early_stop']:
+            return None
+        if not conf['client stream']:
+            logging.warning('Early stopping needs streamed games. Analysing every game of each job')
+            return None
+        return EarlyStop(
+            minGames=conf['client early_stop_games'],
+            below=conf['client early_stop_below'],
+            above=conf['client early_stop_above'])
+
+    def stop(self, games: int, activation: Opt[int]) -> bool:
+        """
+        True if a running activation over `games` predicted games is settled
+        """
+        return activation is not None and games >= self.minGames and (activation < self.below or activation >= self.above)
@@ -0,0 +1,145 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+from modules.game.Game import Game
+from modules.game.Colour import Colour
+from modules.game.AnalysedGame import AnalysedGame
+from modules.game.AnalysedMove import AnalysedMove
+from modules.game.EngineTools import EngineTools, PositionTask
+from modules.game.PositionCache import PositionCache
+from modules.game.PositionMemo import PositionMemo
+from modules.game.NodeAllocation import NodeAllocation
+from modules.game.EngineStats import EngineStats
+
+from modules.client.EngineSupervisor import EngineSupervisor
+
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from typing import Callable
+
+import threading
+
+class EnginePool(NamedTuple('EnginePool', [
+        ('engines', List[EngineTools]),
+        ('idle', Queue),
+        ('executor', ThreadPoolExecutor),
+        ('supervisor', EngineSupervisor)
+    ])):
+    """
+    A pool of independent stockfish processes, each with its own EngineTools.
+    Work is handed to whichever engine is idle, so many narrow engines can
+    analyse a job concurrently instead of one wide engine. Engines that hang
+    or crash are replaced by the supervisor.
+    """
+    @staticmethod
+    def new(conf: ConfigWrapper, positionCache: Opt[PositionCache] = None, stats: Opt[EngineStats] = None):
+        size = max(1, conf['stockfish engines'])
+        stats = EngineStats() if stats is None else stats
+        engines = [EngineTools.new(conf, positionCache, stats) for _ in range(size)]
+        idle = Queue()
+        [idle.put(slot) for slot in range(size)]
+
+        logging.warning(f'Started {size} engines with {conf["stockfish threads"]} threads each')
+
+        supervisor = EngineSupervisor(conf, positionCache, stats)
+        [supervisor.pin(slot, engineTools) for slot, engineTools in enumerate(engines)]
+
+        return EnginePool(
+            engines=engines,
+            idle=idle,
+            executor=ThreadPoolExecutor(max_workers=size),
+            supervisor=supervisor)
+
+    def size(self) -> int:
+        return len(self.engines)
+
+    def stats(self) -> EngineStats:
+        return self.engines[0].stats
+
+    def engineName(self) -> str:
+        """
+        All engines in the pool run the same binary. Marked when they search with the
+        adaptive node budget, see EngineTools.searcher
+        """
+        return self.engines[0].searcher()
+
+    def analyseGame(self, game: Game, colour: Colour, nodes: int, memo: Opt[PositionMemo] = None) -> Opt[AnalysedGame]:
+        """
+        Borrow an idle engine for the duration of one game
+        """
+        return self.analyseGroup([(game, colour)], nodes, memo)[0]
+
+    def analyseGroup(self, games: List[Tuple[Game, Colour]], nodes: int, memo: Opt[PositionMemo] = None, onGame: Opt[Callable[[Game, Opt[AnalysedGame]], None]] = None, allocation: Opt[NodeAllocation] = None, stop: Opt[threading.Event] = None) -> List[Opt[AnalysedGame]]:
+        """
+        Borrow an idle engine and analyse the games on it in order, clearing its hash
+        only before the first, so games that share an opening reuse each other's search.
+        `onGame` is called as each game is finished. With an `allocation` each position
+        gets the nodes allocated to it rather than `nodes`. Once `stop` is set no further
+        game is started, and only the games analysed so far are returned.
+        """
+        slot = self.idle.get()
+        try:
+            analysedGames = []
+            for i, (game, colour) in enumerate(games):
+                if stop is not None and stop.is_set():
+                    break
+                analysedGame = self.analyseOn(slot, game, colour, nodes, memo, newGame=(i == 0), allocation=allocation)
+                if onGame is not None:
+                    onGame(game, analysedGame)
+                analysedGames.append(analysedGame)
+            return analysedGames
+        finally:
+            self.idle.put(slot)
+
+    def analyseOn(self, slot: int, game: Game, colour: Colour, nodes: int, memo: Opt[PositionMemo], newGame: bool, allocation: Opt[NodeAllocation] = None) -> Opt[AnalysedGame]:
+        """
+        Analyse a game on the engine in `slot`. Positions are run one by one under
+        the supervisor, so a failure only repeats one position.
+        """
+        tasks = EngineTools.positionTasks(game, colour)
+        if tasks is None:
+            return None
+
+        try:
+            if newGame:
+                self.supervisor.run(self.engines, slot, lambda e: e.newGame())
+            analysedMoves = [self.supervisor.run(self.engines, slot, lambda e: e.analysePosition(task, NodeAllocation.nodesFor(allocation, nodes, game.id, task), memo)) for task in tasks]
+        except EngineSupervisor.failures:
+            logging.error(f'Giving up on {game.id} after repeated engine failures')
+            return None
+
+        return EngineTools.analysedGame(game, colour, analysedMoves, NodeAllocation.meanNodes(allocation, nodes, game.id, tasks))
+
+    def analysePosition(self, task: PositionTask, nodes: int, memo: Opt[PositionMemo] = None) -> AnalysedMove:
+        """
+        Borrow an idle engine for the duration of one position
+        """
+        slot = self.idle.get()
+        try:
+            return self.supervisor.run(self.engines, slot, lambda e: e.analysePosition(task, nodes, memo))
+        finally:
+            self.idle.put(slot)
+
+    def shardGame(self, game: Game, colour: Colour, nodes: int, memo: Opt[PositionMemo] = None, allocation: Opt[NodeAllocation] = None) -> Opt[AnalysedGame]:
+        """
+        Replay the game once and spread its positions over every engine in the pool.
+        AnalysedMoves are put back together in ply order.
+        """
+        tasks = EngineTools.positionTasks(game, colour)
+        if tasks is None:
+            return None
+
+        try:
+            analysedMoves = list(self.executor.map(lambda task: self.analysePosition(task, NodeAllocation.nodesFor(allocation, nodes, game.id, task), memo), tasks))
+        except EngineSupervisor.failures:
+            logging.error(f'Giving up on {game.id} after repeated engine failures')
+            return None
+
+        return EngineTools.analysedGame(game, colour, analysedMoves, NodeAllocation.meanNodes(allocation, nodes, game.id, tasks))
+
+    def map(self, f, *iterables) -> Iterable:
+        """
+        Run `f` concurrently over the pool's workers, yielding results in input order
+        """
+        return self.executor.map(f, *iterables)
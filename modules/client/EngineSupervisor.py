@@ -0,0 +1,126 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+from modules.game.EngineTools import EngineTools
+from modules.game.AsyncEngineTools import AsyncEngineTools
+from modules.game.PositionCache import PositionCache
+from modules.game.EngineStats import EngineStats
+
+from modules.client.Affinity import Affinity
+
+from chess.engine import EngineTerminatedException
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable
+
+import asyncio
+import threading
+
+T = TypeVar('T')
+
+class EngineSupervisor:
+    """
+    EngineSupervisor(conf: ConfigWrapper, positionCache: Opt[PositionCache], stats: EngineStats)
+
+    Watches the engines of an EnginePool. When a call on an engine overruns its
+    deadline or the engine dies, the engine is killed, a standby engine takes its
+    slot and the call is retried on it. A new standby is started in the background.
+    With `stockfish affinity` the engine in each slot is pinned to the slot's CPUs.
+    """
+    failures = (TimeoutError, EngineTerminatedException)
+
+    def __init__(self, conf: ConfigWrapper, positionCache: Opt[PositionCache], stats: EngineStats):
+        self.conf = conf
+        self.positionCache = positionCache
+        self.stats = stats
+        self.retries = conf['stockfish watchdog_retries']
+        self.restarts = 0
+        self.affinity = Affinity.new(conf)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.standby = self.executor.submit(self.start) if conf['stockfish watchdog_standby'] else None
+
+    def start(self) -> EngineTools:
+        return EngineTools.new(self.conf, self.positionCache, self.stats)
+
+    def pin(self, slot: int, engineTools: EngineTools):
+        if self.affinity is not None:
+            self.affinity.pin(slot, engineTools.pid())
+
+    def replace(self, engineTools: EngineTools) -> EngineTools:
+        engineTools.kill()
+        with self.lock:
+            self.restarts += 1
+            logging.warning(f'Restarting engine ({self.restarts} restarts so far)')
+            standby = self.standby
+            if standby is not None:
+                self.standby = self.executor.submit(self.start)
+        self.stats.incr('engineRestarts')
+        return self.start() if standby is None else standby.result()
+
+    def run(self, engines: List[EngineTools], slot: int, f: Callable[[EngineTools], T]) -> T:
+        """
+        f(engines[slot]), restarting the engine in that slot and retrying on failure.
+        Raises the last failure once the retries are used up; the slot is left
+        with a working engine either way.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return f(engines[slot])
+            except EngineSupervisor.failures as e:
+                logging.warning(f'Engine {slot} failed: {e!r}')
+                self.stats.incr('engineTimeouts' if isinstance(e, TimeoutError) else 'engineCrashes')
+                engines[slot] = self.replace(engines[slot])
+                self.pin(slot, engines[slot])
+                if attempt == self.retries:
+                    raise
+
+class AsyncEngineSupervisor:
+    """
+    AsyncEngineSupervisor(conf: ConfigWrapper, positionCache: Opt[PositionCache], stats: EngineStats)
+
+    EngineSupervisor for an AsyncEnginePool. Must be created on the pool's event loop.
+    """
+    failures = (asyncio.TimeoutError, EOFError, BrokenPipeError, ConnectionResetError)
+
+    def __init__(self, conf: ConfigWrapper, positionCache: Opt[PositionCache], stats: EngineStats):
+        self.conf = conf
+        self.positionCache = positionCache
+        self.stats = stats
+        self.retries = conf['stockfish watchdog_retries']
+        self.restarts = 0
+        self.affinity = Affinity.new(conf)
+        self.standby = asyncio.ensure_future(self.start()) if conf['stockfish watchdog_standby'] else None
+
+    async def start(self) -> AsyncEngineTools:
+        return await AsyncEngineTools.new(self.conf, self.positionCache, self.stats)
+
+    def pin(self, slot: int, engineTools: AsyncEngineTools):
+        if self.affinity is not None:
+            self.affinity.pin(slot, engineTools.pid())
+
+    async def replace(self, engineTools: AsyncEngineTools) -> AsyncEngineTools:
+        await engineTools.kill()
+        self.restarts += 1
+        logging.warning(f'Restarting engine ({self.restarts} restarts so far)')
+        self.stats.incr('engineRestarts')
+        if self.standby is None:
+            return await self.start()
+        standby, self.standby = self.standby, asyncio.ensure_future(self.start())
+        return await standby
+
+    async def run(self, engines: List[AsyncEngineTools], slot: int, f: Callable[[AsyncEngineTools], Awaitable[T]]) -> T:
+        """
+        See EngineSupervisor.run
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return await f(engines[slot])
+            except AsyncEngineSupervisor.failures as e:
+                logging.warning(f'Engine {slot} failed: {e!r}')
+                self.stats.incr('engineTimeouts' if isinstance(e, asyncio.TimeoutError) else 'engineCrashes')
+                engines[slot] = await self.replace(engines[slot])
+                self.pin(slot, engines[slot])
+                if attempt == self.retries:
+                    raise
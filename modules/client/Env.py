@@ -2,13 +2,19 @@ from default_imports import *
 
 from conf.ConfigWrapper import ConfigWrapper
 
-from modules.game.EngineTools import EngineTools
+from modules.client.EnginePool import EnginePool
+from modules.client.AsyncEnginePool import AsyncEnginePool
+from modules.client.Journal import Journal
+from modules.game.PositionCache import PositionCache
 
 class Env:
     def __init__(self, config: ConfigWrapper, token: Opt[str] = None):
         self.config = config
         self.url = "{}://{}:{}".format(self.config.server.protocol, self.config.server.domain, self.config.server.port)
-        self.engineTools = EngineTools.new(self.config)
+        self.positionCache = PositionCache.new(self.config)
+        self.enginePool = (AsyncEnginePool if self.config['stockfish driver'] == 'async' else EnginePool).new(self.config, self.positionCache)
+        self.journal = Journal.new(self.config)
+        self.packed = False # set once the server has answered with a packed job
         if token is None:
             self.auth = self.config.auth.asdict()
         else:
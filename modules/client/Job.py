@@ -7,7 +7,9 @@ from modules.game.AnalysedPosition import AnalysedPosition, AnalysedPositionBSON
 class Job(NamedTuple('Job', [
         ('playerId', PlayerID),
         ('games', List[Game]),
-        ('analysedPositions', List[AnalysedPosition])
+        ('analysedPositions', List[AnalysedPosition]),
+        ('targetSeconds', Opt[int]), # finish within this many seconds if possible, rather than at full depth
+        ('deep', bool) # analyse every game deeply, without a pipeline client's triage
     ])):
     @staticmethod
     def fromJson(json: Dict):
@@ -26,12 +28,16 @@ class JobBSONHandler:
         return Job(
             playerId = bson['playerId'],
             games = [GameBSONHandler.reads(g) for g in bson['games']],
-            analysedPositions = [AnalysedPositionBSONHandler.reads(ap) for ap in bson['analysedPositions']])
+            analysedPositions = [AnalysedPositionBSONHandler.reads(ap) for ap in bson['analysedPositions']],
+            targetSeconds = bson.get('targetSeconds'),
+            deep = bson.get('deep', False))
 
     @staticmethod
     def writes(job: Job) -> Dict:
         return {
             'playerId': job.playerId,
-            'games': [g.toJson() for g in job.games],
-            'analysedPositions': [AnalysedPositionBSONHandler.writes(ap) for ap in job.analysedPositions]
+            'games': [g.toJobJson() for g in job.games],
+            'analysedPositions': [AnalysedPositionBSONHandler.writes(ap) for ap in job.analysedPositions],
+            'targetSeconds': job.targetSeconds,
+            'deep': job.deep
         }
\ No newline at end of file
@@ -0,0 +1,72 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+from modules.game.Player import PlayerID
+from modules.game.AnalysedGame import AnalysedGame, AnalysedGameBSONHandler
+
+from threading import Lock
+
+import json
+import os
+
+class Journal(NamedTuple('Journal', [
+        ('path', str),
+        ('lock', Lock)
+    ])):
+    """
+    Local record of every game analysed for the job in progress, one JSON line
+    per AnalysedGame in a file per player. A restarted client reads it back and
+    only analyses the games that are missing.
+    """
+    @staticmethod
+    def new(conf: ConfigWrapper) -> Opt['Journal']:
+        path = conf['client journal']
+        if not path:
+            return None
+        os.makedirs(path, exist_ok=True)
+        return Journal(path=path, lock=Lock())
+
+    def filename(self, playerId: PlayerID) -> str:
+        return os.path.join(self.path, f'{playerId}.jsonl')
+
+    def write(self, analysedGame: AnalysedGame):
+        line = json.dumps(analysedGame.toJson())
+        with self.lock:
+            with open(self.filename(analysedGame.playerId), 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self, playerId: PlayerID) -> List[AnalysedGame]:
+        """
+        Analysed games journaled for playerId, keyed by game ID so the last entry wins.
+        A line cut short by a crash is dropped and the journal rewritten without it,
+        so later entries are not appended onto it.
+        """
+        analysedGames = {}
+        damaged = False
+        try:
+            with open(self.filename(playerId)) as f:
+                for line in f:
+                    try:
+                        analysedGame = AnalysedGameBSONHandler.reads(json.loads(line))
+                        analysedGames[analysedGame.gameId] = analysedGame
+                    except (json.decoder.JSONDecodeError, KeyError):
+                        logging.warning(f'Skipping damaged journal entry for {playerId}')
+                        damaged = True
+        except FileNotFoundError:
+            pass
+
+        if damaged:
+            self.clear(playerId)
+            [self.write(analysedGame) for analysedGame in analysedGames.values()]
+
+        return list(analysedGames.values())
+
+    def clear(self, playerId: PlayerID):
+        with self.lock:
+            try:
+                os.remove(self.filename(playerId))
+            except FileNotFoundError:
+                pass
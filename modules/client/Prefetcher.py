@@ -0,0 +1,120 @@
+from default_imports import *
+
+from modules.game.Player import PlayerID
+from modules.client.Api import Api
+from modules.client.Job import Job
+
+from queue import Queue, Empty
+
+import threading
+
+class Prefetcher:
+    """
+    Prefetcher(api: Api, depth: int)
+
+    Leases jobs in a background thread and keeps up to `depth` of them ready,
+    so the next job is waiting as soon as the engines finish the current one.
+    Free places are filled with a single request for as many jobs.
+    Every job handed out is held until `release` is called after its upload,
+    and held jobs are excluded from requests so the server does not lease
+    the same player back. With a depth of 0 jobs are requested on demand.
+    `close` gives back the jobs leased ahead when the client shuts down, and
+    waits for a request in flight so the jobs it leases are given back too.
+    """
+    def __init__(self, api: Api, depth: int):
+        self.api = api
+        self.depth = depth
+        self.held = set()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.closing = threading.Event() # cuts short the pause after the server had no job
+        self.jobs = Queue()
+        self.room = threading.Semaphore(depth) # only lease a job when there is room to keep it
+        self.thread = None
+        if depth > 0:
+            self.thread = threading.Thread(target=self.run, name='prefetch', daemon=True)
+            self.thread.start()
+
+    def request(self, count: int = 1) -> List[Job]:
+        with self.lock:
+            exclude = list(self.held)
+        jobs = self.api.requestJobs(exclude, count)
+        with self.lock:
+            self.held.update(job.playerId for job in jobs)
+        return jobs
+
+    def run(self):
+        while True:
+            self.room.acquire()
+            count = self.free(1)
+            jobs = [] if self.closed else self.request(count)
+            while len(jobs) == 0 and not self.closed:
+                logging.warning('Job is None. Pausing')
+                self.closing.wait(10)
+                count = self.free(count)
+                jobs = self.request(count)
+            with self.lock:
+                if not self.closed:
+                    [self.jobs.put(job) for job in jobs]
+                    [self.room.release() for _ in range(count - len(jobs))] # the server leased fewer
+                    continue
+            [self.give(job) for job in jobs]
+            return
+
+    def free(self, count: int) -> int:
+        """
+        `count` places already taken, plus any others that are free
+        """
+        while count < self.depth and self.room.acquire(blocking=False):
+            count += 1
+        return count
+
+    def next(self, stop: Opt[threading.Event] = None) -> Opt[Job]:
+        """
+        The next job, waiting for one if none is ready. None with a depth of 0
+        if no job was available, or once closed or `stop` is set.
+        """
+        if self.depth > 0:
+            while not self.closed and not (stop is not None and stop.is_set()):
+                try:
+                    job = self.jobs.get(timeout=1)
+                except Empty:
+                    continue
+                self.room.release()
+                return job
+            return None
+        jobs = self.request()
+        return jobs[0] if len(jobs) > 0 else None
+
+    def close(self):
+        """
+        Stop leasing jobs and give back those leased ahead, including any the
+        leasing thread is requesting now
+        """
+        with self.lock:
+            self.closed = True
+            jobs = []
+            while not self.jobs.empty():
+                jobs.append(self.jobs.get())
+        [self.give(job) for job in jobs]
+        self.closing.set()
+        self.room.release() # wake the leasing thread if it is waiting for room
+        if self.thread is not None:
+            self.thread.join()
+
+    def give(self, job: Job):
+        response = self.api.releaseJob(job.playerId)
+        if response is None or response.status_code != 200:
+            logging.warning(f'Failed to release {job.playerId}')
+        self.release(job.playerId)
+
+    def holding(self) -> List[PlayerID]:
+        """
+        Players whose jobs are leased to this client: waiting, being analysed or uploaded
+        """
+        with self.lock:
+            return list(self.held)
+
+    def release(self, playerId: PlayerID):
+        with self.lock:
+            self.held.discard(playerId)
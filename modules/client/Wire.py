@@ -0,0 +1,217 @@
+from default_imports import *
+
+from array import array
+
+import base64
+import binascii
+import chess
+import json
+import struct
+import sys
+import zlib
+
+# every move code (from | to << 6 | promotion << 12) and its uci; None when there is no pv
+moveUcis = {f | t << 6 | p << 12: chess.SQUARE_NAMES[f] + chess.SQUARE_NAMES[t] + ' nbrq'[p].strip()
+    for f in range(64) for t in range(64) for p in range(5)}
+moveUcis.update({0xFFFE: '0000', 0xFFFF: None})
+moveCodes = {uci: code for code, uci in moveUcis.items()}
+
+class Columns:
+    """
+    Typed arrays the numeric fields of a payload are packed into. Fields are read
+    back in the order they were written.
+    """
+    types = [
+        ('moves', 'H'), # codes of moveUcis
+        ('moveNumbers', 'H'),
+        ('emts', 'i'),
+        ('cps', 'h'),
+        ('mates', 'h'),
+        ('counts', 'B')] # analyses per move
+
+    def __init__(self, arrays: Opt[Dict[str, list]] = None):
+        self.arrays = {name: array(t) for name, t in Columns.types} if arrays is None else arrays
+        self.at = {name: 0 for name, _ in Columns.types}
+
+    def write(self, name: str, values: List[int]):
+        self.arrays[name].extend(values)
+
+    def take(self, name: str, n: int) -> List[int]:
+        i = self.at[name]
+        self.at[name] = i + n
+        return self.arrays[name][i:i+n]
+
+    def tobytes(self) -> bytes:
+        chunks = []
+        for name, _ in Columns.types:
+            a = self.arrays[name]
+            if sys.byteorder == 'big':
+                a = array(a.typecode, a)
+                a.byteswap()
+            chunks.extend([struct.pack('<I', len(a)), a.tobytes()])
+        return b''.join(chunks)
+
+    @staticmethod
+    def frombytes(data: bytes, offset: int) -> 'Columns':
+        arrays = {}
+        for name, t in Columns.types:
+            n, = struct.unpack_from('<I', data, offset)
+            a = array(t)
+            size = n * a.itemsize
+            a.frombytes(data[offset+4:offset+4+size])
+            if len(a) != n:
+                raise ValueError(f'column {name} is cut short')
+            if sys.byteorder == 'big':
+                a.byteswap()
+            arrays[name] = a.tolist()
+            offset += 4 + size
+        return Columns(arrays)
+
+class Wire:
+    """
+    The packed encoding of api payloads. Analysed games, games and analysed positions
+    have their moves, emts and evals packed into typed columns and the rest into a
+    JSON header; both are compressed and sent base64 encoded in a JSON envelope that
+    keeps `auth` readable. Payloads that are not packed pass through unchanged.
+    """
+    packed = 'packed'
+    none = -32768 # cp or mate not given
+    noEmt = -2**31
+
+    @staticmethod
+    def isPacked(payload: Opt[Dict]) -> bool:
+        return isinstance(payload, dict) and payload.get('encoding') == Wire.packed
+
+    @staticmethod
+    def pack(payload: Dict) -> Dict:
+        columns = Columns()
+        packers = {
+            'job': Wire.packJob,
+            'analysedGame': Wire.packAnalysedGame,
+            'analysedGames': lambda columns, ags: [Wire.packAnalysedGame(columns, ag) for ag in ags],
+            'jobs': lambda columns, jobs: [Wire.packJob(columns, job) for job in jobs]}
+        header = {k: (packers[k](columns, v) if k in packers else v) for k, v in payload.items() if k != 'auth'}
+        headerBytes = json.dumps(header, separators=(',', ':')).encode()
+        body = zlib.compress(struct.pack('<I', len(headerBytes)) + headerBytes + columns.tobytes())
+        envelope = {'encoding': Wire.packed, 'body': base64.b64encode(body).decode('ascii')}
+        if 'auth' in payload:
+            envelope['auth'] = payload['auth']
+        return envelope
+
+    @staticmethod
+    def unpack(payload: Opt[Dict]) -> Opt[Dict]:
+        """
+        Raises ValueError if a packed payload is damaged
+        """
+        if not Wire.isPacked(payload):
+            return payload
+        try:
+            body = zlib.decompress(base64.b64decode(payload['body']))
+            n, = struct.unpack_from('<I', body, 0)
+            header = json.loads(body[4:4+n].decode())
+            columns = Columns.frombytes(body, 4+n)
+            unpackers = {
+                'job': Wire.unpackJob,
+                'analysedGame': Wire.unpackAnalysedGame,
+                'analysedGames': lambda columns, ags: [Wire.unpackAnalysedGame(columns, ag) for ag in ags],
+                'jobs': lambda columns, jobs: [Wire.unpackJob(columns, job) for job in jobs]}
+            unpacked = {k: (unpackers[k](columns, v) if k in unpackers else v) for k, v in header.items()}
+        except (KeyError, IndexError, TypeError, zlib.error, binascii.Error, struct.error, json.decoder.JSONDecodeError) as e:
+            raise ValueError(f'damaged packed payload: {e!r}')
+        if 'auth' in payload:
+            unpacked['auth'] = payload['auth']
+        return unpacked
+
+    @staticmethod
+    def clip(value: Opt[Number]) -> int:
+        return Wire.none if value is None else max(-32767, min(32767, int(value)))
+
+    @staticmethod
+    def packEvals(columns: Columns, evals: List[Dict]):
+        columns.write('cps', [Wire.clip(e.get('cp')) for e in evals])
+        columns.write('mates', [Wire.clip(e.get('mate')) for e in evals])
+
+    @staticmethod
+    def unpackEvals(columns: Columns, n: int) -> List[Dict]:
+        # as EngineEval.asdict writes them
+        return [{'cp': cp} if cp != Wire.none else {'mate': None if mate == Wire.none else mate}
+            for cp, mate in zip(columns.take('cps', n), columns.take('mates', n))]
+
+    @staticmethod
+    def packAnalyses(columns: Columns, analysesPerMove: List[List[Dict]]):
+        columns.write('counts', [len(analyses) for analyses in analysesPerMove])
+        analyses = [a for moveAnalyses in analysesPerMove for a in moveAnalyses]
+        columns.write('moves', [moveCodes[a['uci']] for a in analyses])
+        Wire.packEvals(columns, [a['score'] for a in analyses])
+
+    @staticmethod
+    def unpackAnalyses(columns: Columns, n: int) -> List[List[Dict]]:
+        counts = columns.take('counts', n)
+        total = sum(counts)
+        analyses = [{'uci': moveUcis[m], 'score': s} for m, s in zip(columns.take('moves', total), Wire.unpackEvals(columns, total))]
+        perMove, at = [], 0
+        for count in counts:
+            perMove.append(analyses[at:at+count])
+            at += count
+        return perMove
+
+    @staticmethod
+    def packAnalysedGame(columns: Columns, bson: Dict) -> Dict:
+        moves = bson['analysis']
+        columns.write('moves', [moveCodes[am['uci']] for am in moves])
+        columns.write('moveNumbers', [am['move'] for am in moves])
+        columns.write('emts', [Wire.noEmt if am['emt'] is None else am['emt'] for am in moves])
+        Wire.packEvals(columns, [am['score'] for am in moves])
+        Wire.packAnalyses(columns, [am['analyses'] for am in moves])
+        return {**bson, 'analysis': len(moves)}
+
+    @staticmethod
+    def unpackAnalysedGame(columns: Columns, header: Dict) -> Dict:
+        n = header['analysis']
+        moves = zip(
+            [moveUcis[m] for m in columns.take('moves', n)],
+            columns.take('moveNumbers', n),
+            [None if e == Wire.noEmt else e for e in columns.take('emts', n)],
+            Wire.unpackEvals(columns, n),
+            Wire.unpackAnalyses(columns, n))
+        return {**header, 'analysis': [{'uci': u, 'move': m, 'emt': e, 'score': s, 'analyses': a} for u, m, e, s, a in moves]}
+
+    @staticmethod
+    def packGame(columns: Columns, json: Dict) -> Dict:
+        emts = json['emts']
+        if emts is not None:
+            columns.write('emts', [Wire.noEmt if e is None else e for e in emts])
+        header = {**json, 'pgn': ' '.join(json['pgn']), 'emts': None if emts is None else len(emts)}
+        if 'analysis' in json:
+            Wire.packEvals(columns, json['analysis'])
+            header['analysis'] = len(json['analysis'])
+        return header
+
+    @staticmethod
+    def unpackGame(columns: Columns, header: Dict) -> Dict:
+        emts = None if header['emts'] is None else [None if e == Wire.noEmt else e for e in columns.take('emts', header['emts'])]
+        game = {**header, 'pgn': header['pgn'].split(' ') if header['pgn'] else [], 'emts': emts}
+        if 'analysis' in header:
+            game['analysis'] = Wire.unpackEvals(columns, header['analysis'])
+        return game
+
+    @staticmethod
+    def packAnalysedPosition(columns: Columns, bson: Dict) -> Dict:
+        Wire.packAnalyses(columns, [bson['analyses']])
+        return {'_id': bson['_id']}
+
+    @staticmethod
+    def unpackAnalysedPosition(columns: Columns, header: Dict) -> Dict:
+        return {'_id': header['_id'], 'analyses': Wire.unpackAnalyses(columns, 1)[0]}
+
+    @staticmethod
+    def packJob(columns: Columns, json: Dict) -> Dict:
+        return {**json,
+            'games': [Wire.packGame(columns, g) for g in json['games']],
+            'analysedPositions': [Wire.packAnalysedPosition(columns, ap) for ap in json['analysedPositions']]}
+
+    @staticmethod
+    def unpackJob(columns: Columns, header: Dict) -> Dict:
+        return {**header,
+            'games': [Wire.unpackGame(columns, g) for g in header['games']],
+            'analysedPositions': [Wire.unpackAnalysedPosition(columns, ap) for ap in header['analysedPositions']]}
@@ -20,19 +20,33 @@ class AnalysedGame(NamedTuple('AnalysedGame', [
         ('id', AnalysedGameID),
         ('playerId', PlayerID),
         ('gameId', GameID),
-        ('analysedMoves', List[AnalysedMove])
+        ('analysedMoves', List[AnalysedMove]),
+        ('shallow', bool),
+        ('nodes', Opt[int])
     ])):
     """
     An analysed game is a game that has been deeply analysed from a single
-    player's perspective.
+    player's perspective. A `shallow` one only has the triage analysis of a
+    pipeline client: it is not used for training and its game is handed out
+    again to be analysed deeply. `nodes` is the mean node budget its positions
+    were searched with, None for games analysed before it was recorded.
     """
     @staticmethod
-    def new(gameId: GameID, colour: Colour, playerId: PlayerID, analysedMoves: List[AnalysedMove]):
+    def new(gameId: GameID, colour: Colour, playerId: PlayerID, analysedMoves: List[AnalysedMove], shallow: bool = False, nodes: Opt[int] = None):
         return AnalysedGame(
             id=AnalysedGame.makeId(gameId, colour),
             playerId=playerId,
             gameId=gameId,
-            analysedMoves=analysedMoves)
+            analysedMoves=analysedMoves,
+            shallow=shallow,
+            nodes=nodes)
+
+    def deep(self, nodes: int) -> bool:
+        """
+        Analysed in full at a budget of `nodes`: not shallow, nor fitted into a target time
+        below it
+        """
+        return not self.shallow and (self.nodes is None or self.nodes >= nodes)
 
     @staticmethod
     def makeId(gameId: GameID, colour: Colour) -> AnalysedGameID:
@@ -189,7 +203,9 @@ class AnalysedGameBSONHandler:
             id = bson['_id'],
             playerId = bson['userId'],
             gameId = bson['gameId'],
-            analysedMoves = [AnalysedMoveBSONHandler.reads(am) for am in bson['analysis']])
+            analysedMoves = [AnalysedMoveBSONHandler.reads(am) for am in bson['analysis']],
+            shallow = bson.get('shallow', False),
+            nodes = bson.get('nodes'))
 
     @staticmethod
     def writes(analysedGame: AnalysedGame) -> Dict:
@@ -197,7 +213,9 @@ class AnalysedGameBSONHandler:
             '_id': analysedGame.id,
             'userId': analysedGame.playerId,
             'gameId': analysedGame.gameId,
-            'analysis': [AnalysedMoveBSONHandler.writes(am) for am in analysedGame.analysedMoves]
+            'analysis': [AnalysedMoveBSONHandler.writes(am) for am in analysedGame.analysedMoves],
+            'shallow': analysedGame.shallow,
+            'nodes': analysedGame.nodes
         }
 
 class AnalysedGameDB(NamedTuple('AnalysedGameDB', [
@@ -215,6 +233,20 @@ class AnalysedGameDB(NamedTuple('AnalysedGameDB', [
     def byPlayerId(self, playerId: PlayerID) -> List[AnalysedGame]:
         return [AnalysedGameBSONHandler.reads(ga) for ga in self.analysedGameColl.find({'userId': playerId})]
 
+    def deepByPlayerId(self, playerId: PlayerID, nodes: int) -> List[AnalysedGame]:
+        """
+        The player's analysed games that are deep at a budget of `nodes` (see AnalysedGame.deep), for training
+        """
+        return [AnalysedGameBSONHandler.reads(ga) for ga in self.analysedGameColl.find(
+            {'userId': playerId, 'shallow': {'$ne': True}, 'nodes': {'$not': {'$lt': nodes}}})]
+
+    def gameIdsByPlayerId(self, playerId: PlayerID, deep: bool = False) -> List[GameID]:
+        """
+        With `deep` shallow analyses are left out
+        """
+        query = {'userId': playerId, 'shallow': {'$ne': True}} if deep else {'userId': playerId}
+        return [ga['gameId'] for ga in self.analysedGameColl.find(query, {'gameId': 1})]
+
     def byPlayerIds(self, playerIds: List[PlayerID]) -> List[AnalysedGame]:
         return [self.byPlayerId(playerId) for playerId in playerIds]
 
@@ -3,6 +3,7 @@ from default_imports import *
 from modules.game.AnalysedMove import Analysis, AnalysisBSONHandler
 from chess import polyglot, Board
 from pymongo.collection import Collection
+from pymongo import UpdateOne
 import pymongo
 import logging
 
@@ -23,8 +24,15 @@ class AnalysedPosition(NamedTuple('AnalysedPosition', [
             analyses=analyses)
 
     @staticmethod
-    def idFromBoard(board: Board) -> AnalysedPositionID:
-        return str(polyglot.zobrist_hash(board))
+    def idFromBoard(board: Board, nodes: Opt[int] = None, engine: Opt[str] = None) -> AnalysedPositionID:
+        """
+        The polyglot zobrist hash of the board. When a node budget and engine are
+        given the id is scoped to them, so analyses at different depths don't mix.
+        """
+        _id = str(polyglot.zobrist_hash(board))
+        if nodes is None:
+            return _id
+        return f'{_id}/{nodes}/{engine}'
 
 class AnalysedPositionBSONHandler:
     @staticmethod
@@ -52,8 +60,19 @@ class AnalysedPositionDB(NamedTuple('AnalysedPositionDB', [
             logging.warning("DuplicateKeyError when attempting to write position: " + str(analysedPosition.id))
 
     def writeMany(self, analysedPositions: List[AnalysedPosition]):
-        [self.write(analysedPosition) for analysedPosition in analysedPositions]
+        if len(analysedPositions) == 0:
+            return
+        try:
+            self.analysedPositionColl.bulk_write([UpdateOne(
+                {'_id': analysedPosition.id},
+                {'$set': AnalysedPositionBSONHandler.writes(analysedPosition)},
+                upsert=True) for analysedPosition in analysedPositions], ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            logging.warning("BulkWriteError when attempting to write positions: " + str(e.details.get('writeErrors')))
+
+    def byBoard(self, board: Board, nodes: Opt[int] = None, engine: Opt[str] = None) -> Opt[AnalysedPosition]:
+        analysedPositionBSON = self.analysedPositionColl.find_one({'_id': AnalysedPosition.idFromBoard(board, nodes, engine)})
+        return None if analysedPositionBSON is None else AnalysedPositionBSONHandler.reads(analysedPositionBSON)
 
-    def byBoard(self, board: Board) -> Opt[AnalysedPosition]:
-        analysedPositionBSON = self.analysedPositionColl.find_one({'_id': AnalysedPosition.idFromBoard(board)})
-        return None if analysedPositionBSON is None else AnalysedPositionBSONHandler.reads(analysedPositionBSON)
\ No newline at end of file
+    def byIds(self, ids: List[AnalysedPositionID]) -> List[AnalysedPosition]:
+        return [AnalysedPositionBSONHandler.reads(bson) for bson in self.analysedPositionColl.find({'_id': {'$in': ids}})]
\ No newline at end of file
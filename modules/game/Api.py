@@ -2,6 +2,7 @@ from default_imports import *
 import logging
 
 from modules.game.AnalysedGame import AnalysedGameBSONHandler
+from modules.game.AnalysedPosition import AnalysedPosition
 
 from modules.game.Env import Env
 
@@ -21,24 +22,36 @@ class Api(NamedTuple('Api', [
             logging.warning('Malformed analysedGamesBSON: ' + str(analysedGamesBSON))
         return False
 
-    def gamesForAnalysis(self, playerId: PlayerID, required: List[str] = []) -> List[Game]:
+    def gamesForAnalysis(self, playerId: PlayerID, required: List[str] = [], analysis: bool = True, deep: bool = False) -> List[Game]:
         """
         Given a playerId and an amount of games. This function will return the games within `limit`
-        that should be analysed
+        that should be analysed. The games only hold what a job uses, and lichess's analysis
+        only with `analysis`. With `deep` games with only a shallow analysis are analysed again.
         """
-        games = self.env.gameDB.byPlayerId(playerId)
-        analysedGames = self.env.analysedGameDB.byPlayerId(playerId)
-
-        gameIds = {g.id for g in games}
-        analysedGameIds = {g.gameId for g in analysedGames}
+        analysedGameIds = set(self.env.analysedGameDB.gameIdsByPlayerId(playerId, deep=deep))
 
         notAnalysedButRequiredIds = set(required) - analysedGameIds
+        games = self.env.gameDB.forJob(playerId, list(notAnalysedButRequiredIds), analysis)
 
         correct_length = lambda g: len(g.pgn) >= 40 and len(g.pgn) <= 120
-        games = [g for g in games if g.id in notAnalysedButRequiredIds and correct_length(g)]
+        games = [g for g in games if correct_length(g)]
 
         return games
 
+    def analysedPositionsForGames(self, playerId: PlayerID, games: List[Game], nodes: int, engine: str) -> List[AnalysedPosition]:
+        """
+        Cached analyses, at `nodes` by `engine`, of every position in `games`
+        that `playerId` had to move from
+        """
+        ids = {AnalysedPosition.idFromBoard(board, nodes, engine) for game in games for board in game.boards(game.white == playerId)}
+        return self.env.analysedPositionDB.byIds(list(ids))
+
+    def writeAnalysedPositions(self, analysedPositions: List[AnalysedPosition]):
+        """
+        Store positions analysed by a client so they can be served with later jobs
+        """
+        self.env.analysedPositionDB.writeMany(analysedPositions)
+
     def gamesByIds(self, gameIds: List[GameID]):
         return self.env.gameDB.byIds(gameIds)
 
@@ -0,0 +1,242 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+from modules.game.Game import Game
+from modules.game.Colour import Colour
+from modules.game.AnalysedGame import AnalysedGame
+from modules.game.EngineEval import EngineEval
+from modules.game.AnalysedPosition import AnalysedPosition
+from modules.game.AnalysedMove import AnalysedMove, Analysis
+from modules.game.PositionCache import PositionCache
+from modules.game.PositionMemo import PositionMemo
+from modules.game.EngineStats import EngineStats
+from modules.game.EngineTools import EngineTools, PositionTask
+
+from modules.fishnet.fishnet import stockfish_command
+
+from chess import Board, STARTING_FEN
+
+import asyncio
+
+class AsyncUciEngine:
+    """
+    AsyncUciEngine(process: asyncio.subprocess.Process, name: str)
+
+    Minimal UCI driver on asyncio. While searching it only remembers the latest
+    `info` line of each PV and parses them once `bestmove` arrives, so a search
+    costs a handful of parsed lines however long it runs.
+    """
+    def __init__(self, process: asyncio.subprocess.Process, name: str):
+        self.process = process
+        self.name = name
+        self.searched = 0 # nodes the last search reported
+
+    @staticmethod
+    async def start(command: str, options: Dict[str, int]) -> 'AsyncUciEngine':
+        process = await asyncio.create_subprocess_exec(command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE)
+        engine = AsyncUciEngine(process, command)
+
+        engine.send('uci')
+        while True:
+            line = await engine.readline()
+            if line.startswith('id name '):
+                engine.name = line[len('id name '):]
+            elif line == 'uciok':
+                break
+
+        for name, value in options.items():
+            engine.send(f'setoption name {name} value {value}')
+        await engine.isready()
+        return engine
+
+    def send(self, command: str):
+        self.process.stdin.write((command + '\n').encode())
+
+    async def readline(self) -> str:
+        line = await self.process.stdout.readline()
+        if not line:
+            raise EOFError(f'{self.name} terminated')
+        return line.decode().rstrip()
+
+    async def isready(self):
+        self.send('isready')
+        while await self.readline() != 'readyok':
+            pass
+
+    async def ucinewgame(self):
+        self.send('ucinewgame')
+        await self.isready()
+
+    async def search(self, board: Board, nodes: int, multipv: int) -> List[Analysis]:
+        self.send(f'setoption name MultiPV value {multipv}')
+        self.send(AsyncUciEngine.positionCommand(board))
+        self.send(f'go nodes {nodes}')
+
+        # like chess.uci, scores that are only bounds are ignored but their pv is kept
+        scores, pvs = {}, {}
+        self.searched = nodes
+        while True:
+            line = await self.readline()
+            if line.startswith('bestmove'):
+                break
+            if line.startswith('info') and ' nodes ' in line:
+                self.searched = int(line.split(' nodes ', 1)[1].split(' ', 1)[0])
+            if line.startswith('info') and ' score ' in line:
+                i = line.find(' multipv ')
+                multipv = 1 if i < 0 else int(line[i+9:].split(' ', 1)[0])
+                if ' pv ' in line:
+                    pvs[multipv] = line
+                if 'bound ' not in line:
+                    scores[multipv] = line
+
+        return [AsyncUciEngine.analysis(scores[i], pvs.get(i)) for i in sorted(scores)]
+
+    async def kill(self):
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+        await self.process.wait()
+
+    async def quit(self):
+        self.send('quit')
+        await self.process.wait()
+
+    @staticmethod
+    def positionCommand(board: Board) -> str:
+        """
+        Initial position and the moves since, so the engine sees repetitions
+        """
+        fen = board.root().fen()
+        command = 'position startpos' if fen == STARTING_FEN else f'position fen {fen}'
+        if board.move_stack:
+            command += ' moves ' + ' '.join(move.uci() for move in board.move_stack)
+        return command
+
+    @staticmethod
+    def analysis(scoreLine: str, pvLine: Opt[str]) -> Analysis:
+        tokens = scoreLine.split()
+        i = tokens.index('score')
+        cp, mate = (int(tokens[i+2]), None) if tokens[i+1] == 'cp' else (None, int(tokens[i+2]))
+        if pvLine is None: # no pv when the position is already mate
+            return Analysis(None, EngineEval(cp, mate))
+        return Analysis(pvLine.split(' pv ', 1)[1].split(' ', 1)[0], EngineEval(cp, mate))
+
+class AsyncEngineTools(NamedTuple('AsyncEngineTools', [
+        ('engine', AsyncUciEngine),
+        ('config', ConfigWrapper),
+        ('positionCache', Opt[PositionCache]),
+        ('stats', EngineStats)
+    ])):
+    """
+    EngineTools for an AsyncUciEngine. Same analysis, as coroutines, so many
+    engines can be driven from one event loop.
+    """
+    @staticmethod
+    async def new(conf: ConfigWrapper, positionCache: Opt[PositionCache] = None, stats: Opt[EngineStats] = None):
+        if conf['stockfish budget adaptive']:
+            logging.warning('Adaptive node budgets need every info line and are not applied by the async driver')
+        engine = await AsyncUciEngine.start(
+            stockfish_command(conf['stockfish update'], conf['stockfish path']),
+            {'Threads': conf['stockfish threads'], 'Hash': conf['stockfish memory']})
+        return AsyncEngineTools(
+            engine=engine,
+            config=conf,
+            positionCache=positionCache,
+            stats=EngineStats() if stats is None else stats)
+
+    def name(self) -> str:
+        return self.engine.name
+
+    def searcher(self) -> str:
+        """
+        See EngineTools.searcher. This driver always searches `nodes` in full
+        """
+        return self.name()
+
+    def pid(self) -> int:
+        return self.engine.process.pid
+
+    async def newGame(self):
+        await asyncio.wait_for(self.engine.ucinewgame(), self.config['stockfish watchdog_grace'])
+
+    async def kill(self):
+        await self.engine.kill()
+
+    async def analyseGame(self, game: Game, colour: Colour, nodes: int, memo: Opt[PositionMemo] = None, newGame: bool = True) -> Opt[AnalysedGame]:
+        tasks = EngineTools.positionTasks(game, colour)
+        if tasks is None:
+            return None
+
+        if newGame:
+            await self.newGame()
+
+        analysedMoves = [await self.analysePosition(task, nodes, memo) for task in tasks]
+
+        return EngineTools.analysedGame(game, colour, analysedMoves, nodes)
+
+    async def analysePosition(self, task: PositionTask, nodes: int, memo: Opt[PositionMemo] = None) -> AnalysedMove:
+        """
+        See EngineTools.analysePosition
+        """
+        positionId = None if memo is None else AnalysedPosition.idFromBoard(task.board, nodes, self.searcher())
+        analyses = EngineTools.memoised(self.stats, memo, positionId)
+
+        if analyses is None:
+            analyses = await self.search(task.board, nodes, 5)
+
+            if memo is not None:
+                memo.analysedPositions[positionId] = AnalysedPosition(id=positionId, analyses=analyses)
+
+        engineEval = await self.playedMoveEval(task, nodes, analyses, memo)
+
+        return AnalysedMove(
+            uci = task.uci,
+            move = task.move,
+            emt = task.emt,
+            engineEval = engineEval,
+            analyses = analyses)
+
+    async def playedMoveEval(self, task: PositionTask, nodes: int, analyses: List[Analysis], memo: Opt[PositionMemo] = None) -> EngineEval:
+        """
+        See EngineTools.playedMoveEval
+        """
+        if EngineTools.useGameEval(self.config, self.stats, task):
+            return task.gameEval
+
+        pvEval = EngineTools.pvEval(self.config, task, analyses)
+        if EngineTools.reusePv(self.config, self.stats, pvEval):
+            return pvEval
+
+        nextId = None if memo is None else AnalysedPosition.idFromBoard(task.nextBoard, nodes, self.searcher())
+        nextEval = None if memo is None else memo.playedMoveEvals.get(nextId)
+        if nextEval is not None:
+            self.stats.incr('dedupPlayedMove')
+        else:
+            nextEval = (await self.search(task.nextBoard, nodes, 1))[0].engineEval
+            if memo is not None:
+                memo.playedMoveEvals[nextId] = nextEval
+        engineEval = nextEval.inverse() # flipped because analysing from other player side
+
+        EngineTools.auditPv(self.config, self.stats, pvEval, engineEval)
+        return engineEval
+
+    async def search(self, board: Board, nodes: int, multipv: int) -> List[Analysis]:
+        """
+        MultiPV search of `board`, served from the position cache when possible
+        """
+        if self.positionCache is not None:
+            analyses = self.positionCache.get(board, nodes, multipv, self.searcher())
+            if analyses is not None:
+                return analyses
+
+        analyses = await asyncio.wait_for(self.engine.search(board, nodes, multipv), EngineTools.deadline(self.config, nodes))
+        self.stats.incr('nodesRequested', self.engine.searched)
+
+        if self.positionCache is not None:
+            self.positionCache.put(board, nodes, multipv, self.searcher(), analyses)
+
+        return analyses
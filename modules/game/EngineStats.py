@@ -0,0 +1,44 @@
+from default_imports import *
+
+from collections import Counter
+
+import threading
+
+class EngineStats:
+    """
+    EngineStats()
+
+    Counters and observed values shared by the engines of a client. Reported
+    and reset after each job.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.observations = {}
+
+    def incr(self, key: str, amount: Number = 1):
+        with self.lock:
+            self.counts[key] += amount
+
+    def observe(self, key: str, value: Number):
+        """
+        Keep the count, mean and maximum of `value` under `key`
+        """
+        with self.lock:
+            count, total, maximum = self.observations.get(key, (0, 0, value))
+            self.observations[key] = (count + 1, total + value, max(maximum, value))
+
+    def get(self, key: str) -> Number:
+        return self.counts[key]
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.observations.clear()
+
+    def summary(self) -> str:
+        with self.lock:
+            counts = [f'{key}: {value}' for key, value in sorted(self.counts.items())]
+            observations = [f'{key}: mean {total/count:.1f}, max {maximum} (n={count})'
+                for key, (count, total, maximum) in sorted(self.observations.items())]
+        return 'engine stats: ' + ', '.join(counts + observations)
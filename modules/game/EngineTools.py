@@ -2,45 +2,269 @@ from default_imports import *
 
 from conf.ConfigWrapper import ConfigWrapper
 
-from modules.game.Game import Game
+from modules.game.Game import Game, Emt
 from modules.game.Colour import Colour
 from modules.game.AnalysedGame import AnalysedGame
 from modules.game.EngineEval import EngineEval
-from modules.game.AnalysedPosition import AnalysedPosition, AnalysedPositionDB
-from modules.game.AnalysedMove import AnalysedMove, Analysis
+from modules.game.AnalysedPosition import AnalysedPosition, AnalysedPositionID
+from modules.game.AnalysedMove import AnalysedMove, Analysis, UCI, MoveNumber
+from modules.game.PositionCache import PositionCache
+from modules.game.PositionMemo import PositionMemo
+from modules.game.EngineStats import EngineStats
+from modules.game.NodeBudget import NodeBudget, BudgetInfoHandler
 
 from modules.fishnet.fishnet import stockfish_command
 
+from chess import Board
 from chess.pgn import read_game
 
 from chess import uci
 from chess.uci import Engine
 from chess.uci import InfoHandler
 
+import random
+
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 
+PositionTask = NamedTuple('PositionTask', [
+        ('board', Board), # position the player moved from
+        ('nextBoard', Board), # position after the move played
+        ('uci', UCI),
+        ('move', MoveNumber),
+        ('emt', Emt),
+        ('gameEval', Opt[EngineEval]) # lichess's eval of the move played, from the player's side
+    ])
+
 class EngineTools(NamedTuple('EngineTools', [
         ('engine', Engine),
-        ('infoHandler', InfoHandler)
+        ('infoHandler', InfoHandler),
+        ('config', ConfigWrapper),
+        ('positionCache', Opt[PositionCache]),
+        ('stats', EngineStats)
     ])):
     @staticmethod
-    def new(conf: ConfigWrapper):
+    def new(conf: ConfigWrapper, positionCache: Opt[PositionCache] = None, stats: Opt[EngineStats] = None):
         engine = uci.popen_engine(stockfish_command(conf['stockfish update'], conf['stockfish path']))
         engine.setoption({'Threads': conf['stockfish threads'], 'Hash': conf['stockfish memory']})
         engine.uci()
 
-        infoHandler = uci.InfoHandler()
+        nodeBudget = NodeBudget.new(conf)
+        infoHandler = uci.InfoHandler() if nodeBudget is None else BudgetInfoHandler(engine, nodeBudget)
 
         engine.info_handlers.append(infoHandler)
 
         return EngineTools(
             engine=engine,
-            infoHandler=infoHandler)
+            infoHandler=infoHandler,
+            config=conf,
+            positionCache=positionCache,
+            stats=EngineStats() if stats is None else stats)
+
+    def name(self) -> str:
+        return self.engine.name
+
+    def searcher(self) -> str:
+        """
+        The engine's name, marked when searches follow the adaptive node budget. Cached
+        and uploaded analyses are keyed by it, so searches cut short or extended by the
+        budget are never served to a client that searches `nodes` in full.
+        """
+        return self.name() + ('/adaptive' if isinstance(self.infoHandler, BudgetInfoHandler) else '')
+
+    def pid(self) -> int:
+        return self.engine.process.process.pid
+
+    def newGame(self):
+        self.engine.ucinewgame(async_callback=True).result(timeout=self.config['stockfish watchdog_grace'])
+
+    def kill(self):
+        try:
+            self.engine.kill()
+        except Exception as e:
+            logging.warning(f'Failed to kill engine: {e!r}')
+
+    def analyseGame(self, game: Game, colour: Colour, nodes: int, memo: Opt[PositionMemo] = None, newGame: bool = True) -> Opt[AnalysedGame]:
+        """
+        With `newGame` false the engine's hash is kept from the previous game
+        """
+        tasks = EngineTools.positionTasks(game, colour)
+        if tasks is None:
+            return None
+
+        if newGame:
+            self.newGame()
+
+        analysedMoves = [self.analysePosition(task, nodes, memo) for task in tasks]
+
+        return EngineTools.analysedGame(game, colour, analysedMoves, nodes)
+
+    def analysePosition(self, task: PositionTask, nodes: int, memo: Opt[PositionMemo] = None) -> AnalysedMove:
+        """
+        Search the position the player moved from (MultiPV) and the position
+        they moved to (for the eval of the move played).
+        If `memo` is given, positions already searched for the job are not
+        searched again and new searches are added to it.
+        """
+        positionId = None if memo is None else AnalysedPosition.idFromBoard(task.board, nodes, self.searcher())
+        analyses = EngineTools.memoised(self.stats, memo, positionId)
+
+        if analyses is None:
+            logging.info(f'analysing position\n{task.board}\n')
+            analyses = self.search(task.board, nodes, 5)
+
+            if memo is not None:
+                memo.analysedPositions[positionId] = AnalysedPosition(id=positionId, analyses=analyses)
+
+        engineEval = self.playedMoveEval(task, nodes, analyses, memo)
+
+        return AnalysedMove(
+            uci = task.uci,
+            move = task.move,
+            emt = task.emt,
+            engineEval = engineEval,
+            analyses = analyses)
+
+    def playedMoveEval(self, task: PositionTask, nodes: int, analyses: List[Analysis], memo: Opt[PositionMemo] = None) -> EngineEval:
+        """
+        Eval of the move played, from the player's side. With `stockfish game_evals`
+        it is lichess's own eval when the game has one. With `stockfish reuse_pv`
+        it is taken from the MultiPV analyses when the move is among them, and the
+        position after the move is only searched when it is not. A fraction
+        (`stockfish reuse_pv_audit`) of reusable moves is searched anyway to
+        measure how far the two evals differ.
+        """
+        if EngineTools.useGameEval(self.config, self.stats, task):
+            return task.gameEval
+
+        pvEval = EngineTools.pvEval(self.config, task, analyses)
+        if EngineTools.reusePv(self.config, self.stats, pvEval):
+            return pvEval
+
+        nextId = None if memo is None else AnalysedPosition.idFromBoard(task.nextBoard, nodes, self.searcher())
+        nextEval = None if memo is None else memo.playedMoveEvals.get(nextId)
+        if nextEval is not None:
+            self.stats.incr('dedupPlayedMove')
+        else:
+            nextEval = self.search(task.nextBoard, nodes, 1)[0].engineEval
+            if memo is not None:
+                memo.playedMoveEvals[nextId] = nextEval
+        engineEval = nextEval.inverse() # flipped because analysing from other player side
+
+        EngineTools.auditPv(self.config, self.stats, pvEval, engineEval)
+        return engineEval
+
+    def search(self, board: Board, nodes: int, multipv: int) -> List[Analysis]:
+        """
+        MultiPV search of `board`, served from the position cache when possible.
+        With `stockfish budget adaptive` the search may stop before `nodes`, and close
+        positions are searched again with extra nodes, see NodeBudget. Raises
+        TimeoutError if the engine overruns its deadline.
+        """
+        if self.positionCache is not None:
+            analyses = self.positionCache.get(board, nodes, multipv, self.searcher())
+            if analyses is not None:
+                return analyses
+
+        self.engine.setoption({'multipv': multipv})
+        self.engine.position(board)
 
-    def analyseGame(self, game: Game, colour: Colour, nodes: int) -> Opt[AnalysedGame]:
+        budgeted = isinstance(self.infoHandler, BudgetInfoHandler)
+        self.go(self.infoHandler.start(board, nodes, multipv) if budgeted else nodes)
+        if budgeted:
+            self.infoHandler.finish(self.stats)
+            extra = self.infoHandler.extend()
+            if extra > 0:
+                # the hash keeps the first search, so this one carries on from its depth
+                self.go(extra)
+                self.infoHandler.finish(self.stats)
+
+        pvs = self.infoHandler.info['pv']
+        analyses = [
+            Analysis(
+                pvs[i][0].uci() if pvs.get(i) else None, # no pv when the position is already mate
+                EngineEval(score.cp, score.mate)) for i, score in self.infoHandler.info['score'].items()]
+
+        if self.positionCache is not None:
+            self.positionCache.put(board, nodes, multipv, self.searcher(), analyses)
+
+        return analyses
+
+    def go(self, nodes: int):
+        """
+        Search the engine's position to at most `nodes`, counting the nodes it searched
+        """
+        self.engine.go(nodes=nodes, async_callback=True).result(timeout=EngineTools.deadline(self.config, nodes))
+        self.stats.incr('nodesRequested', self.infoHandler.info.get('nodes', nodes))
+
+    @staticmethod
+    def deadline(conf: ConfigWrapper, nodes: int) -> float:
+        """
+        Seconds a search of `nodes` may take before the engine is considered hung
+        """
+        return conf['stockfish watchdog_grace'] + nodes / (conf['stockfish watchdog_nps'] * conf['stockfish threads'])
+
+    @staticmethod
+    def memoised(stats: EngineStats, memo: Opt[PositionMemo], positionId: Opt[AnalysedPositionID]) -> Opt[List[Analysis]]:
+        """
+        MultiPV analyses of positionId if the job has them already
+        """
+        analysedPosition = None if memo is None else memo.analysedPositions.get(positionId)
+        if analysedPosition is None:
+            return None
+        stats.incr('serverCached' if positionId in memo.servedIds else 'dedupMultiPV')
+        return analysedPosition.analyses
+
+    @staticmethod
+    def useGameEval(conf: ConfigWrapper, stats: EngineStats, task: PositionTask) -> bool:
+        """
+        Whether to use lichess's eval of the move played rather than searching for it
+        """
+        if conf['stockfish game_evals']:
+            stats.incr('gameEvalUsed' if task.gameEval is not None else 'gameEvalMissing')
+            return task.gameEval is not None
+        return False
+
+    @staticmethod
+    def pvEval(conf: ConfigWrapper, task: PositionTask, analyses: List[Analysis]) -> Opt[EngineEval]:
+        """
+        Eval of the move played from the MultiPV analyses, if reuse is on and it is among them
+        """
+        if not conf['stockfish reuse_pv']:
+            return None
+        return next((a.engineEval for a in analyses if a.uci == task.uci), None)
+
+    @staticmethod
+    def reusePv(conf: ConfigWrapper, stats: EngineStats, pvEval: Opt[EngineEval]) -> bool:
+        """
+        Whether to use `pvEval` as is, rather than searching the position after the move
+        """
+        if pvEval is not None and random.random() >= conf['stockfish reuse_pv_audit']:
+            stats.incr('pvReused')
+            return True
+        return False
+
+    @staticmethod
+    def auditPv(conf: ConfigWrapper, stats: EngineStats, pvEval: Opt[EngineEval], engineEval: EngineEval):
+        """
+        Record how `pvEval` compares with the searched eval of the move played
+        """
+        if pvEval is not None:
+            stats.incr('pvAudited')
+            if pvEval.cp is not None and engineEval.cp is not None:
+                stats.observe('pvAuditCpDiff', abs(pvEval.cp - engineEval.cp))
+            elif pvEval != engineEval:
+                stats.incr('pvAuditMateMismatch')
+        elif conf['stockfish reuse_pv']:
+            stats.incr('pvMissed')
+
+    @staticmethod
+    def positionTasks(game: Game, colour: Colour) -> Opt[List[PositionTask]]:
+        """
+        Replay the game once and list the positions where `colour` is to move
+        """
         gameLen = len(game.pgn)
         if gameLen < 40 or gameLen > 120:
             logging.warning(f'game too long/short to analyse ({gameLen} plys)')
@@ -48,7 +272,6 @@ class EngineTools(NamedTuple('EngineTools', [
         elif game.emts is None:
             logging.warning(f'game has no emts')
             return None
-        analysedMoves = []
 
         try:
             playableGame = read_game(StringIO(" ".join(game.pgn)))
@@ -61,44 +284,28 @@ class EngineTools(NamedTuple('EngineTools', [
             logging.warning(f"Not enough emts. len(emts): {len(game.emts)} vs len(node.main_line()): {len(mainline_moves)}")
             return None
 
-        self.engine.ucinewgame()
-
+        tasks = []
         while not node.is_end():
-            logging.info(f'analysing position\n{node.board()}\n')
             nextNode = node.variation(0)
-            if colour == node.board().turn: ## if it is the turn of the player of interest
-                self.engine.setoption({'multipv': 5})
-                self.engine.position(node.board())
-                self.engine.go(nodes=nodes)
-
-                analyses = list([
-                    Analysis(
-                        pv[1][0].uci(),
-                        EngineEval(engineEval[1].cp, engineEval[1].mate)) for engineEval, pv in zip(
-                            self.infoHandler.info['score'].items(),
-                            self.infoHandler.info['pv'].items())])
-
-                self.engine.setoption({'multipv': 1})
-                self.engine.position(nextNode.board())
-                self.engine.go(nodes=nodes)
-
-                engineEval = EngineEval(
-                    self.infoHandler.info['score'][1].cp,
-                    self.infoHandler.info['score'][1].mate).inverse() # flipped because analysing from other player side
-
-                moveNumber = node.board().fullmove_number
-
-                analysedMoves.append(AnalysedMove(
-                    uci = node.variation(0).move.uci(),
+            board = node.board()
+            if colour == board.turn: ## if it is the turn of the player of interest
+                moveNumber = board.fullmove_number
+                ply = EngineTools.ply(moveNumber, colour)
+                tasks.append(PositionTask(
+                    board = board,
+                    nextBoard = nextNode.board(),
+                    uci = nextNode.move.uci(),
                     move = moveNumber,
-                    emt = game.emts[EngineTools.ply(moveNumber, colour)],
-                    engineEval = engineEval,
-                    analyses = analyses))
-
+                    emt = game.emts[ply],
+                    gameEval = game.evalAfter(ply, colour)))
             node = nextNode
 
+        return tasks
+
+    @staticmethod
+    def analysedGame(game: Game, colour: Colour, analysedMoves: List[AnalysedMove], nodes: Opt[int] = None) -> AnalysedGame:
         playerId = game.white if colour else game.black
-        return AnalysedGame.new(game.id, colour, playerId, analysedMoves)
+        return AnalysedGame.new(game.id, colour, playerId, analysedMoves, nodes=nodes)
 
     @staticmethod
     def ply(moveNumber, colour: Colour) -> int:
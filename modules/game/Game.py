@@ -54,6 +54,22 @@ class Game(NamedTuple('Game', [
             'analysed': len(self.analysis) > 0
         }
 
+    def toJobJson(self):
+        """
+        The fields a client analyses the game from. Lichess's analysis is left out
+        when the game has none, or it was dropped because the client has no use for it.
+        """
+        json = {
+            '_id': self.id,
+            'white': self.white,
+            'black': self.black,
+            'pgn': self.pgn,
+            'emts': self.emts
+        }
+        if len(self.analysis) > 0:
+            json['analysis'] = [EngineEvalBSONHandler.writes(a) for a in self.analysis]
+        return json
+
 
     def playable(self):
         try:
@@ -63,6 +79,50 @@ class Game(NamedTuple('Game', [
 
         return read_game(StringIO(" ".join(self.pgn)))
 
+    def boards(self, colour: Colour) -> List[chess.Board]:
+        """
+        Positions where `colour` is to move and a move was played, in game order.
+        The moves are replayed on one board, which is much cheaper than walking
+        the parsed PGN; the positions stop at the first move that does not parse.
+        """
+        board = chess.Board()
+        boards = []
+        for san in self.pgn:
+            try:
+                move = board.parse_san(san)
+            except ValueError:
+                break
+            if board.turn == colour:
+                boards.append(board.copy(stack=False))
+            board.push(move)
+        return boards
+
+    def evalAfter(self, ply: int, colour: Colour) -> Opt[EngineEval]:
+        """
+        Lichess's eval of the position after ply `ply` (0 is white's first move), from
+        `colour`'s side. None if the game was not analysed that far.
+        """
+        if ply >= len(self.analysis):
+            return None
+        engineEval = self.analysis[ply] # from white's side
+        return engineEval if colour else engineEval.inverse()
+
+    @staticmethod
+    def openingGroups(games: List['Game'], plies: int, maxSize: int) -> List[List['Game']]:
+        """
+        Games in trie order (sorted by their moves) grouped by their first `plies` moves,
+        largest groups first. Groups are split to hold at most `maxSize` games.
+        """
+        if plies <= 0:
+            return [[game] for game in games]
+
+        groups = {}
+        for game in sorted(games, key=lambda g: g.pgn):
+            groups.setdefault(tuple(game.pgn[:plies]), []).append(game)
+
+        chunks = [group[i:i+maxSize] for group in groups.values() for i in range(0, len(group), max(1, maxSize))]
+        return sorted(chunks, key=len, reverse=True)
+
     def boardTensors(self, colour):
         # replay the game for move tensors
         playable = self.playable()
@@ -193,6 +253,17 @@ class GameDB(NamedTuple('GameDB', [
     def byPlayerId(self, playerId: PlayerID) -> List[Game]:
         return [GameBSONHandler.reads(g) for g in self.gameColl.find({"$or": [{"white": playerId}, {"black": playerId}]})]
 
+    def forJob(self, playerId: PlayerID, ids: List[GameID], analysis: bool = True) -> List[Game]:
+        """
+        Games in `ids` that `playerId` played, with only the fields a job uses.
+        Lichess's analysis is only loaded with `analysis`.
+        """
+        projection = {'white': 1, 'black': 1, 'pgn': 1, 'emts': 1}
+        if analysis:
+            projection['analysis'] = 1
+        return [GameBSONHandler.reads(g) for g in self.gameColl.find(
+            {'_id': {'$in': ids}, '$or': [{'white': playerId}, {'black': playerId}]}, projection)]
+
     def byPlayerIdAndAnalysed(self, playerId: PlayerID, analysed: bool = True) -> List[Game]:
         return [GameBSONHandler.reads(g) for g in self.gameColl.find({"analysed": analysed, "$or": [{"white": playerId}, {"black": playerId}]})]
 
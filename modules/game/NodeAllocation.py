@@ -0,0 +1,89 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+from modules.game.Game import Game, GameID
+from modules.game.Colour import Colour
+from modules.game.AnalysedMove import MoveNumber
+from modules.game.EngineTools import EngineTools, PositionTask
+
+class NodeAllocation(NamedTuple('NodeAllocation', [
+        ('nodes', int),
+        ('positions', Dict[Tuple[GameID, MoveNumber], int])
+    ])):
+    """
+    Nodes per position for a job that has to be done within a target time. The
+    job's total budget is shared out in proportion to how much each position can
+    tell about the player, but no position gets more than the full `nodes`. So
+    low-impact positions are cut first, and critical ones only once the others
+    are down to `client deadline_min_nodes`.
+    """
+    openingMoves = 6 # positions up to this move are mostly book
+    openingWeight = 0.25
+    forcedWeight = 0.2 # few legal moves
+    lopsidedWeight = 0.4 # lichess's eval says the game is decided
+
+    @staticmethod
+    def new(conf: ConfigWrapper, games: List[Tuple[Game, Colour]], nodes: int, seconds: Number, nodesPerSecond: Number) -> Opt['NodeAllocation']:
+        """
+        None if the full `nodes` for every position fits in `seconds`
+        """
+        tasks = [(game, task) for game, colour in games for task in (EngineTools.positionTasks(game, colour) or [])]
+        searches = [NodeAllocation.searches(conf, task) for _, task in tasks]
+        budget = seconds * nodesPerSecond
+        if nodes * sum(searches) <= budget or len(tasks) == 0:
+            return None
+
+        weights = [NodeAllocation.weight(conf, task) for _, task in tasks]
+        scale = NodeAllocation.scale(weights, searches, nodes, budget)
+        minNodes = min(nodes, conf['client deadline_min_nodes'])
+        return NodeAllocation(
+            nodes=nodes,
+            positions={(game.id, task.move): max(minNodes, min(nodes, int(scale * w))) for (game, task), w in zip(tasks, weights)})
+
+    @staticmethod
+    def searches(conf: ConfigWrapper, task: PositionTask) -> int:
+        """
+        Searches run for a position: the MultiPV search and, unless lichess's eval is used, the one after the move
+        """
+        return 1 if conf['stockfish game_evals'] and task.gameEval is not None else 2
+
+    @staticmethod
+    def weight(conf: ConfigWrapper, task: PositionTask) -> float:
+        """
+        How much a full search of the position is worth, between 0 and 1
+        """
+        weight = 1.0
+        if task.move <= NodeAllocation.openingMoves:
+            weight *= NodeAllocation.openingWeight
+        if task.board.legal_moves.count() <= conf['stockfish budget few_moves']:
+            weight *= NodeAllocation.forcedWeight
+        gameEval = task.gameEval
+        if gameEval is not None and (gameEval.mate is not None or abs(gameEval.cp) >= conf['stockfish budget lopsided_cp']):
+            weight *= NodeAllocation.lopsidedWeight
+        return weight
+
+    @staticmethod
+    def scale(weights: List[float], searches: List[int], nodes: int, budget: Number) -> float:
+        """
+        The scale at which sum(searches * min(nodes, scale * weight)) spends `budget`
+        """
+        spend = lambda scale: sum(s * min(nodes, scale * w) for w, s in zip(weights, searches))
+        low, high = 0.0, nodes / min(weights)
+        for _ in range(50):
+            mid = (low + high) / 2
+            low, high = (mid, high) if spend(mid) < budget else (low, mid)
+        return low
+
+    @staticmethod
+    def nodesFor(allocation: Opt['NodeAllocation'], nodes: int, gameId: GameID, task: PositionTask) -> int:
+        return nodes if allocation is None else allocation.positions.get((gameId, task.move), nodes)
+
+    @staticmethod
+    def meanNodes(allocation: Opt['NodeAllocation'], nodes: int, gameId: GameID, tasks: List[PositionTask]) -> int:
+        """
+        Nodes a game's positions are searched with on average, stored with its analysis
+        """
+        if allocation is None or len(tasks) == 0:
+            return nodes
+        return sum(NodeAllocation.nodesFor(allocation, nodes, gameId, task) for task in tasks) // len(tasks)
@@ -0,0 +1,184 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+from modules.game.EngineStats import EngineStats
+
+from chess import Board
+from chess.uci import Engine, InfoHandler
+
+class NodeBudget(NamedTuple('NodeBudget', [
+        ('stableIterations', int),
+        ('stableCp', int),
+        ('minFraction', float),
+        ('fewMoves', int),
+        ('forcedFraction', float),
+        ('lopsidedCp', int),
+        ('lopsidedFraction', float),
+        ('closeCp', int),
+        ('closeFactor', float)
+    ])):
+    """
+    Policy for spending a position's node budget where it matters. A search
+    stops early once the MultiPV ordering and scores have settled, positions
+    with very few legal moves or a lopsided eval are capped, and positions
+    whose top two moves are still close when the budget is spent get a second
+    search with the extra nodes.
+    """
+    @staticmethod
+    def new(conf: ConfigWrapper) -> Opt['NodeBudget']:
+        if not conf['stockfish budget adaptive']:
+            return None
+        return NodeBudget(
+            stableIterations=conf['stockfish budget stable_iterations'],
+            stableCp=conf['stockfish budget stable_cp'],
+            minFraction=conf['stockfish budget min_fraction'],
+            fewMoves=conf['stockfish budget few_moves'],
+            forcedFraction=conf['stockfish budget forced_fraction'],
+            lopsidedCp=conf['stockfish budget lopsided_cp'],
+            lopsidedFraction=conf['stockfish budget lopsided_fraction'],
+            closeCp=conf['stockfish budget close_cp'],
+            closeFactor=conf['stockfish budget close_factor'])
+
+    def limit(self, board: Board, nodes: int, multipv: int) -> int:
+        """
+        Hard node limit to give the engine for this search
+        """
+        if board.legal_moves.count() <= self.fewMoves:
+            return max(1, int(self.forcedFraction*nodes))
+        return nodes
+
+    def extension(self, nodes: int, lines: Opt[List[Tuple[str, Opt[int], Opt[int]]]]) -> int:
+        """
+        Extra nodes to search a position with, given the (uci, cp, mate) lines its
+        search of `nodes` ended on: only when the top two moves are close
+        """
+        if lines is None or len(lines) < 2 or None in [lines[0][1], lines[1][1]]:
+            return 0
+        if abs(lines[0][1] - lines[1][1]) > self.closeCp:
+            return 0
+        return max(0, int((self.closeFactor - 1)*nodes))
+
+    def stopReason(self, nodes: int, searched: int, lines: List[Tuple[str, Opt[int], Opt[int]]], stable: int) -> Opt[str]:
+        """
+        Why the search should stop now, given the (uci, cp, mate) lines of the last
+        completed iteration, or None if it should carry on
+        """
+        if searched < self.minFraction*nodes:
+            return None
+        if stable >= self.stableIterations:
+            return 'budgetStable'
+
+        _, cp, mate = lines[0]
+        if (mate is not None or abs(cp) >= self.lopsidedCp) and searched >= self.lopsidedFraction*nodes:
+            return 'budgetLopsided'
+        return None
+
+    def similar(self, a: List[Tuple[str, Opt[int], Opt[int]]], b: List[Tuple[str, Opt[int], Opt[int]]]) -> bool:
+        """
+        Same moves in the same order, with scores within `stableCp`
+        """
+        if len(a) != len(b):
+            return False
+        for (uciA, cpA, mateA), (uciB, cpB, mateB) in zip(a, b):
+            if uciA != uciB or mateA != mateB:
+                return False
+            if cpA is not None and cpB is not None and abs(cpA - cpB) > self.stableCp:
+                return False
+        return True
+
+class BudgetInfoHandler(InfoHandler):
+    """
+    InfoHandler that applies a NodeBudget while the engine searches, telling
+    it to stop as soon as the budget says the result has settled
+    """
+    def __init__(self, engine: Engine, nodeBudget: NodeBudget):
+        super(BudgetInfoHandler, self).__init__()
+        self.engine = engine
+        self.nodeBudget = nodeBudget
+        self.reset(0, 1)
+
+    def reset(self, nodes: int, lineCount: int, extended: bool = False):
+        self.budgetNodes = nodes
+        self.lineNodes = False
+        self.lineCompletes = False
+        self.lineCount = lineCount
+        self.extended = extended
+        self.lines = None
+        self.stable = 0
+        self.stopped = None
+
+    def start(self, board: Board, nodes: int, multipv: int) -> int:
+        """
+        Prepare for a search of `board` and return the node limit to search with
+        """
+        self.reset(nodes, max(1, min(multipv, board.legal_moves.count())))
+        return self.nodeBudget.limit(board, nodes, multipv)
+
+    def extend(self) -> int:
+        """
+        Extra nodes to search the position with after its search to the budget, 0 if
+        it settled or is not close. When not 0 the handler is ready for that search.
+        """
+        if self.extended or self.stopped is not None or self.lineCount < 2:
+            return 0
+        self.iterationComplete() # the lines the search ended on
+        extra = self.nodeBudget.extension(self.budgetNodes, self.lines)
+        if extra > 0:
+            self.reset(extra, self.lineCount, extended=True)
+        return extra
+
+    def finish(self, stats: EngineStats):
+        searched = self.info.get('nodes', self.budgetNodes)
+        if self.extended:
+            stats.incr('budgetClose')
+            stats.incr('nodesExtended', searched)
+        else:
+            stats.incr('nodesSaved', max(0, self.budgetNodes - searched))
+        if self.stopped is not None:
+            stats.incr(self.stopped)
+
+    def pre_info(self, line: str):
+        super(BudgetInfoHandler, self).pre_info(line)
+        # self.info keeps what earlier lines set, so what this line carries is read from the line itself.
+        # An iteration is complete on an exact score with a pv for the last MultiPV line, not on
+        # lines such as `currmove`, which Stockfish sends once a search runs for a few seconds.
+        tokens = line.split()
+        try:
+            multipv = int(tokens[tokens.index('multipv') + 1]) if 'multipv' in tokens else 1
+        except (ValueError, IndexError):
+            multipv = None
+        self.lineNodes = 'nodes' in tokens
+        self.lineCompletes = (self.lineNodes and 'score' in tokens and 'pv' in tokens
+            and 'lowerbound' not in tokens and 'upperbound' not in tokens and multipv == self.lineCount)
+
+    def post_info(self):
+        try:
+            if self.stopped is None and self.lineNodes:
+                if self.lineCompletes:
+                    self.iterationComplete()
+                if self.lines is not None:
+                    self.check()
+        finally:
+            super(BudgetInfoHandler, self).post_info()
+
+    def iterationComplete(self):
+        pvs, scores = self.info['pv'], self.info['score']
+        if any(pvs.get(i) is None or scores.get(i) is None for i in range(1, self.lineCount + 1)):
+            return
+        lines = [(pvs[i][0].uci(), scores[i].cp, scores[i].mate) for i in range(1, self.lineCount + 1)]
+
+        if self.lines is not None and self.nodeBudget.similar(self.lines, lines):
+            self.stable += 1
+        else:
+            self.stable = 0
+        self.lines = lines
+
+    def check(self):
+        """
+        Judge the last completed iteration against the nodes searched so far,
+        so a search past the budget stops without waiting for its iteration to end
+        """
+        self.stopped = self.nodeBudget.stopReason(self.budgetNodes, self.info['nodes'], self.lines, self.stable)
+        if self.stopped is not None:
+            self.engine.stop(async_callback=True)
@@ -0,0 +1,76 @@
+from default_imports import *
+
+from conf.ConfigWrapper import ConfigWrapper
+
+from modules.game.AnalysedMove import Analysis, AnalysisBSONHandler
+from modules.game.AnalysedPosition import AnalysedPosition
+
+from chess import Board
+
+import json
+import sqlite3
+import threading
+import time
+
+class PositionCache:
+    """
+    PositionCache(path: str, size: int)
+
+    On-disk cache of engine searches, keyed by zobrist hash, node budget,
+    MultiPV count and engine. Survives client restarts. Once more than `size`
+    entries are stored the least recently used ones are evicted.
+    """
+    def __init__(self, path: str, size: int):
+        self.size = size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS position (key TEXT PRIMARY KEY, analyses TEXT NOT NULL, used REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS position_used ON position (used)')
+        self.count = self.conn.execute('SELECT COUNT(*) FROM position').fetchone()[0]
+
+    @staticmethod
+    def new(conf: ConfigWrapper) -> Opt['PositionCache']:
+        path = conf['client cache path']
+        if not path:
+            return None
+        logging.warning(f'Using position cache at {path}')
+        return PositionCache(path, conf['client cache size'])
+
+    @staticmethod
+    def key(board: Board, nodes: int, multipv: int, engine: str) -> str:
+        return f'{AnalysedPosition.idFromBoard(board, nodes, engine)}/{multipv}'
+
+    def get(self, board: Board, nodes: int, multipv: int, engine: str) -> Opt[List[Analysis]]:
+        key = PositionCache.key(board, nodes, multipv, engine)
+        with self.lock:
+            row = self.conn.execute('SELECT analyses FROM position WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute('UPDATE position SET used = ? WHERE key = ?', (time.time(), key))
+        return [AnalysisBSONHandler.reads(a) for a in json.loads(row[0])]
+
+    def put(self, board: Board, nodes: int, multipv: int, engine: str, analyses: List[Analysis]):
+        key = PositionCache.key(board, nodes, multipv, engine)
+        value = json.dumps([AnalysisBSONHandler.writes(a) for a in analyses])
+        with self.lock:
+            inserted = self.conn.execute('INSERT OR IGNORE INTO position (key, analyses, used) VALUES (?, ?, ?)', (key, value, time.time())).rowcount
+            self.count += inserted
+            if self.count > self.size:
+                self.evict(self.count - self.size)
+
+    def evict(self, amount: int):
+        """
+        Remove the `amount` least recently used entries. Expects the lock to be held.
+        """
+        self.count -= self.conn.execute('DELETE FROM position WHERE key IN (SELECT key FROM position ORDER BY used ASC LIMIT ?)', (amount,)).rowcount
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups > 0 else 0
+        return f'position cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate), {self.count}/{self.size} entries'
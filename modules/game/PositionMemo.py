@@ -0,0 +1,29 @@
+from default_imports import *
+
+from modules.game.EngineEval import EngineEval
+from modules.game.AnalysedPosition import AnalysedPosition, AnalysedPositionID
+
+class PositionMemo(NamedTuple('PositionMemo', [
+        ('analysedPositions', Dict[AnalysedPositionID, AnalysedPosition]),
+        ('playedMoveEvals', Dict[AnalysedPositionID, EngineEval]),
+        ('servedIds', set)
+    ])):
+    """
+    Searches made for one job, keyed by AnalysedPosition.idFromBoard, so a position
+    that occurs in several of the job's games is searched once. `analysedPositions`
+    are the MultiPV searches of positions the player moved from, starting with those
+    served by the server; `playedMoveEvals` are the evals of positions after a move,
+    from the side to move there.
+    """
+    @staticmethod
+    def new(analysedPositions: List[AnalysedPosition] = []) -> 'PositionMemo':
+        return PositionMemo(
+            analysedPositions={ap.id: ap for ap in analysedPositions},
+            playedMoveEvals={},
+            servedIds={ap.id for ap in analysedPositions})
+
+    def newPositions(self) -> List[AnalysedPosition]:
+        """
+        MultiPV searches made by this client, for the server to cache
+        """
+        return [ap for _id, ap in self.analysedPositions.items() if _id not in self.servedIds]
@@ -46,7 +46,11 @@ class PlayerReport(NamedTuple('PlayerReport', [
 
     @staticmethod
     def playerPrediction(player: Player, analysedGamePredictions: List[AnalysedGamePrediction]) -> int:
-        sortedGameActivations = sorted([gp.weightedGamePrediction() for gp in analysedGamePredictions], reverse=True)
+        return PlayerReport.playerActivation(player, [gp.weightedGamePrediction() for gp in analysedGamePredictions])
+
+    @staticmethod
+    def playerActivation(player: Player, gameActivations: List[int]) -> int:
+        sortedGameActivations = sorted(gameActivations, reverse=True)
         topGameActivations = sortedGameActivations[:ceil(0.15*len(sortedGameActivations))]
         topGameActivationsAvg = int(np.average(topGameActivations)) if len(topGameActivations) > 0 else 0
 
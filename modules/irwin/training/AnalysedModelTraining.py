@@ -39,7 +39,7 @@ class AnalysedModelTraining(NamedTuple('AnalysedModelTraining', [
         logging.debug("complete")
 
     def getPlayerTensors(self, playerId: str):
-        analysedGames = self.env.analysedGameDB.byPlayerId(playerId)
+        analysedGames = self.env.analysedGameDB.deepByPlayerId(playerId, self.env.config['stockfish nodes'])
         games = self.env.gameDB.byIds([ag.gameId for ag in analysedGames])
 
         return list(filter(None, [GameAnalysedGame(ag, g).tensor() for ag, g in zip(analysedGames, games) if ag.gameLength() <= 60]))
@@ -65,7 +65,7 @@ class AnalysedModelTraining(NamedTuple('AnalysedModelTraining', [
 
     def getTensorByCPE(self, cpe):
         analysedGame = self.env.analysedGameDB.byId(cpe.id)
-        if analysedGame is not None and analysedGame.gameLength() <= 60:
+        if analysedGame is not None and analysedGame.deep(self.env.config['stockfish nodes']) and analysedGame.gameLength() <= 60:
             game = self.env.gameDB.byId(analysedGame.gameId)
             return GameAnalysedGame(analysedGame, game).tensor()
         return None
@@ -144,7 +144,7 @@ class AnalysedModelTraining(NamedTuple('AnalysedModelTraining', [
 
         for i, p in enumerate(cheats):
             logging.info("predicting: " + p.id + "  -  " + str(i) + '/' + lenPlayers)
-            analysedGames = self.env.analysedGameDB.byPlayerId(p.id)
+            analysedGames = self.env.analysedGameDB.deepByPlayerId(p.id, self.env.config['stockfish nodes'])
             games = self.env.gameDB.byIds([ag.gameId for ag in analysedGames])
 
             predictions = self.analysedGameModel.predict([GameAnalysedGame(ag, g) for ag, g in zip(analysedGames, games)])
@@ -130,6 +130,28 @@ class EngineQueueDB(NamedTuple('EngineQueueDB', [
             {'_id': _id},
             {'$set': {'completed': complete, 'owner': None}})
 
+    def release(self, _id: EngineQueueID, owner: AuthID) -> bool:
+        """give an unfinished job leased to owner back to the queue. False if owner did not hold it"""
+        result = self.engineQueueColl.update_one(
+            {'_id': _id, 'owner': owner, 'completed': {'$ne': True}},
+            {'$set': {'owner': None, 'expires': None}})
+        return result.modified_count > 0
+
+    def heartbeat(self, _id: EngineQueueID, owner: AuthID, leaseSeconds: int, progress: Dict = {}) -> bool:
+        """extend owner's lease on an unfinished job and note its progress. False if owner no longer holds it"""
+        result = self.engineQueueColl.update_one(
+            {'_id': _id, 'owner': owner, 'completed': {'$ne': True}},
+            {'$set': {'expires': datetime.now() + timedelta(seconds=leaseSeconds), 'progress': progress}})
+        return result.matched_count > 0
+
+    def reclaimExpired(self) -> int:
+        """give back to the queue every unfinished job whose lease has expired. Returns how many were.
+        Leases without an expiry, of clients that send no heartbeats, never expire"""
+        result = self.engineQueueColl.update_many(
+            {'owner': {'$ne': None}, 'completed': False, 'expires': {'$lt': datetime.now()}},
+            {'$set': {'owner': None, 'expires': None}})
+        return result.modified_count
+
     def removePlayerId(self, playerId: PlayerID):
         """remove all jobs related to playerId"""
         self.engineQueueColl.remove({'_id': playerId})
@@ -152,19 +174,35 @@ class EngineQueueDB(NamedTuple('EngineQueueDB', [
             sort=[('date', pymongo.ASCENDING)])
         return None if bson is None else EngineQueueBSONHandler.reads(bson)
 
-    def nextUnprocessed(self, name: AuthID) -> Opt[EngineQueue]:
-        """find the next job to process against owner's name"""
-        incompleteBSON = self.engineQueueColl.find_one({'owner': name, 'completed': {'$ne': True}})
-        if incompleteBSON is not None: # owner has unfinished business
-            logging.debug(f'{name} is returning to complete {incompleteBSON}')
-            return EngineQueueBSONHandler.reads(incompleteBSON)
-
-        engineQueueBSON = self.engineQueueColl.find_one_and_update(
-            filter={'owner': None, 'completed': False},
-            update={'$set': {'owner': name}},
-            sort=[("precedence", pymongo.DESCENDING),
-                ("date", pymongo.ASCENDING)])
-        return None if engineQueueBSON is None else EngineQueueBSONHandler.reads(engineQueueBSON)
+    def nextUnprocessed(self, name: AuthID, exclude: List[EngineQueueID] = []) -> Opt[EngineQueue]:
+        """find the next job to process against owner's name, other than the jobs in exclude"""
+        engineQueues = self.nextUnprocessedMany(name, 1, exclude)
+        return engineQueues[0] if len(engineQueues) > 0 else None
+
+    def nextUnprocessedMany(self, name: AuthID, count: int, exclude: List[EngineQueueID] = [], leaseSeconds: Opt[int] = None) -> List[EngineQueue]:
+        """
+        find up to count jobs to process against owner's name, other than the jobs in exclude.
+        Each job is leased atomically, so no two owners get the same one. With leaseSeconds
+        the leases expire that long from now unless owner sends heartbeats.
+        """
+        expires = None if leaseSeconds is None else datetime.now() + timedelta(seconds=leaseSeconds)
+        bsons = list(self.engineQueueColl.find({'owner': name, 'completed': {'$ne': True}, '_id': {'$nin': exclude}}).limit(count))
+        if len(bsons) > 0: # owner has unfinished business
+            logging.debug(f'{name} is returning to complete {[b["_id"] for b in bsons]}')
+            self.engineQueueColl.update_many(
+                {'_id': {'$in': [b['_id'] for b in bsons]}, 'owner': name},
+                {'$set': {'expires': expires}})
+
+        while len(bsons) < count:
+            engineQueueBSON = self.engineQueueColl.find_one_and_update(
+                filter={'owner': None, 'completed': False},
+                update={'$set': {'owner': name, 'expires': expires}},
+                sort=[("precedence", pymongo.DESCENDING),
+                    ("date", pymongo.ASCENDING)])
+            if engineQueueBSON is None:
+                break
+            bsons.append(engineQueueBSON)
+        return [EngineQueueBSONHandler.reads(bson) for bson in bsons]
 
     def top(self, amount: int = 20) -> List[EngineQueue]:
         """Return the top `amount` of players, ranked by precedence"""
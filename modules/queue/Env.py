@@ -9,7 +9,9 @@ from modules.queue.IrwinQueue import IrwinQueueDB
 
 class Env:
     def __init__(self, config: ConfigWrapper, db: Collection):
+        self.config = config
         self.db = db
+        self.reclaimedAt = None # monotonic time of the last sweep for expired leases
 
         self.engineQueueDB = EngineQueueDB(db[config['queue coll engine']])
         self.irwinQueueDB = IrwinQueueDB(db[config['queue coll irwin']])
\ No newline at end of file
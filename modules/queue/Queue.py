@@ -4,11 +4,52 @@ from modules.queue.Env import Env
 from modules.queue.EngineQueue import EngineQueue, EngineQueueID
 from modules.game.Player import PlayerID
 
-from modules.auth.Auth import Authable
+from modules.auth.Auth import Authable, AuthID
+
+import time
 
 class Queue(NamedTuple('Queue', [('env', Env)])):
-    def nextEngineAnalysis(self, id: EngineQueueID) -> Opt[EngineQueue]:
-        return self.env.engineQueueDB.nextUnprocessed(id)
+    def nextEngineAnalysis(self, id: AuthID, exclude: List[EngineQueueID] = []) -> Opt[EngineQueue]:
+        engineQueues = self.nextEngineAnalyses(id, 1, exclude)
+        return engineQueues[0] if len(engineQueues) > 0 else None
+
+    def nextEngineAnalyses(self, id: AuthID, count: int, exclude: List[EngineQueueID] = [], heartbeat: bool = False) -> List[EngineQueue]:
+        """
+        Lease up to count engine analyses to id. Only the leases of clients that send
+        heartbeats expire
+        """
+        leaseSeconds = self.env.config['queue lease_seconds'] if heartbeat else None
+        return self.env.engineQueueDB.nextUnprocessedMany(id, count, exclude, leaseSeconds)
+
+    def heartbeat(self, _id: EngineQueueID, owner: AuthID, progress: Dict = {}) -> bool:
+        """
+        Keep owner's lease on the engine analysis of _id, which it is still working on
+        """
+        return self.env.engineQueueDB.heartbeat(_id, owner, self.env.config['queue lease_seconds'], progress)
+
+    def reclaimExpiredLeases(self) -> int:
+        """
+        Put engine analyses whose clients stopped sending heartbeats back in the queue.
+        Sweeps at most once every `queue reclaim_seconds`; 0 between sweeps
+        """
+        now = time.monotonic()
+        if self.env.reclaimedAt is not None and now - self.env.reclaimedAt < self.env.config['queue reclaim_seconds']:
+            return 0
+        self.env.reclaimedAt = now
+        return self.env.engineQueueDB.reclaimExpired()
+
+    def leasedTo(self, _id: EngineQueueID, owner: AuthID) -> bool:
+        """
+        Is the engine analysis of _id currently leased to owner
+        """
+        engineQueue = self.env.engineQueueDB.byId(_id)
+        return engineQueue is not None and engineQueue.owner == owner and not engineQueue.completed
+
+    def releaseEngineAnalysis(self, _id: EngineQueueID, owner: AuthID) -> bool:
+        """
+        Let any client take up the engine analysis of _id, which owner will not finish
+        """
+        return self.env.engineQueueDB.release(_id, owner)
 
     def completeEngineAnalysis(self, _id: EngineQueueID):
         return self.env.engineQueueDB.updateComplete(_id, complete=True)
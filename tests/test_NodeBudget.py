@@ -0,0 +1,61 @@
+from default_imports import *
+
+from chess import uci
+
+from modules.game.NodeBudget import NodeBudget, BudgetInfoHandler
+
+budget = NodeBudget(
+    stableIterations=4, stableCp=10, minFraction=0.0, fewMoves=2, forcedFraction=0.1,
+    lopsidedCp=500, lopsidedFraction=0.3, closeCp=20, closeFactor=2.0)
+
+class StubEngine:
+    def __init__(self):
+        self.stops = 0
+
+    def stop(self, async_callback=None):
+        self.stops += 1
+
+def handler(nodes: int, multipv: int) -> Tuple[BudgetInfoHandler, StubEngine, uci.Engine]:
+    """
+    A handler fed info lines through chess.uci's parser, as during a search
+    """
+    stub = StubEngine()
+    infoHandler = BudgetInfoHandler(stub, budget)
+    parser = uci.Engine()
+    parser.info_handlers.append(infoHandler)
+    infoHandler.start(parser.board, nodes, multipv)
+    return infoHandler, stub, parser
+
+def test_currmove_lines_do_not_complete_iterations():
+    infoHandler, stub, parser = handler(1000000, 1)
+    parser._info('depth 20 seldepth 28 multipv 1 score cp 25 nodes 400000 nps 1000000 time 400 pv e2e4 e7e5')
+    for i in range(5):
+        parser._info(f'depth 21 currmove d2d4 currmovenumber {i+1}')
+    assert infoHandler.stable == 0
+    assert infoHandler.stopped is None
+    assert stub.stops == 0
+
+def test_bound_scores_do_not_complete_iterations():
+    infoHandler, stub, parser = handler(1000000, 1)
+    parser._info('depth 20 multipv 1 score cp 25 nodes 400000 pv e2e4 e7e5')
+    for depth in range(21, 26):
+        parser._info(f'depth {depth} multipv 1 score cp 25 lowerbound nodes 500000 pv e2e4')
+    assert infoHandler.stable == 0
+    assert infoHandler.stopped is None
+
+def test_repeated_iterations_stop_as_stable():
+    infoHandler, stub, parser = handler(1000000, 1)
+    for depth in range(20, 25):
+        parser._info(f'depth {depth} multipv 1 score cp 25 nodes {100000*depth} pv e2e4 e7e5')
+        parser._info(f'depth {depth+1} currmove e2e4 currmovenumber 1')
+    assert infoHandler.stable == 4
+    assert infoHandler.stopped == 'budgetStable'
+    assert stub.stops == 1
+
+def test_iterations_complete_on_last_multipv_line():
+    infoHandler, stub, parser = handler(1000000, 2)
+    for depth in range(20, 23):
+        parser._info(f'depth {depth} multipv 1 score cp 25 nodes {100000*depth} pv e2e4 e7e5')
+        parser._info(f'depth {depth} multipv 2 score cp 10 nodes {100000*depth} pv d2d4 d7d5')
+    assert infoHandler.lines == [('e2e4', 25, None), ('d2d4', 10, None)]
+    assert infoHandler.stable == 2
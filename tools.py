@@ -11,6 +11,7 @@ import json
 from utils.updatePlayerDatabase import updatePlayerDatabase
 from utils.buildAnalysedPositionTable import buildAnalysedPositionTable
 from utils.buildAverageReport import buildAverageReport
+from utils.compareGameEvals import compareGameEvals
 
 from Env import Env
 
@@ -50,6 +51,9 @@ parser.add_argument("--eval", dest="eval", nargs="?",
                     help="evaluate the performance of neural networks")
 parser.add_argument("--test", dest="test", nargs="?",
                 default=False, const=True, help="test on a single player")
+parser.add_argument("--comparegameevals", dest="comparegameevals", type=int, nargs="?",
+                default=0, const=4,
+                    help="compare analysed game activations using searched and lichess evals of the moves played, over this many batches of analysed games")
 parser.add_argument("--discover", dest="discover", nargs="?",
                 default=False, const=True,
                     help="search for cheaters in the database that haven't been marked")
@@ -107,5 +111,8 @@ if args.eval:
 if args.discover:
     env.irwin.discover()
 
+if args.comparegameevals:
+    compareGameEvals(env, args.comparegameevals)
+
 if args.buildaveragereport:
     buildAverageReport(env)
\ No newline at end of file
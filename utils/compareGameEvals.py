@@ -0,0 +1,47 @@
+""" compare analysed game activations using searched and lichess evals of the moves played """
+import logging
+import numpy as np
+from modules.game.AnalysedGame import GameAnalysedGame
+from modules.game.EngineTools import EngineTools
+
+def withGameEvals(analysedGame, game):
+    """
+    The analysed game with the eval of each move played taken from lichess's analysis
+    where it has one, as `stockfish game_evals` would have analysed it
+    """
+    colour = game.white == analysedGame.playerId
+    analysedMoves = []
+    for analysedMove in analysedGame.analysedMoves:
+        gameEval = game.evalAfter(EngineTools.ply(analysedMove.move, colour), colour)
+        analysedMoves.append(analysedMove if gameEval is None else analysedMove._replace(engineEval=gameEval))
+    return analysedGame._replace(analysedMoves=analysedMoves)
+
+def compareGameEvals(env, batches):
+    shifts = []
+    cpDiffs = []
+    for batch in range(batches):
+        logging.info("Processing Batch: " + str(batch))
+        analysedGames = env.analysedGameDB.allBatch(batch)
+        if len(analysedGames) == 0:
+            break
+        games = {g.id: g for g in env.gameDB.byIds([ag.gameId for ag in analysedGames])}
+        pairs = [(ag, games[ag.gameId]) for ag in analysedGames if ag.gameId in games and len(games[ag.gameId].analysis) > 0]
+        hybrids = [withGameEvals(ag, g) for ag, g in pairs]
+
+        searched = env.irwin.analysedGameModel.predict([GameAnalysedGame(ag, g) for ag, g in pairs])
+        lichess = env.irwin.analysedGameModel.predict([GameAnalysedGame(h, g) for h, (_, g) in zip(hybrids, pairs)])
+        shifts.extend([l.weightedGamePrediction() - s.weightedGamePrediction()
+            for s, l in zip(searched, lichess) if s is not None and l is not None])
+        cpDiffs.extend([abs(a.engineEval.cp - b.engineEval.cp)
+            for (ag, _), h in zip(pairs, hybrids) for a, b in zip(ag.analysedMoves, h.analysedMoves)
+            if a is not b and a.engineEval.cp is not None and b.engineEval.cp is not None])
+
+    if len(shifts) == 0:
+        logging.warning('no analysed games with lichess analysis to compare')
+        return
+
+    absShifts = np.abs(shifts)
+    logging.info(f'games compared: {len(shifts)}, moves with a lichess eval: {len(cpDiffs)}')
+    logging.info(f'played move eval difference (cp): mean {np.mean(cpDiffs) if cpDiffs else 0:.1f}, median {np.median(cpDiffs) if cpDiffs else 0:.1f}')
+    logging.info(f'activation shift (lichess - searched): mean {np.mean(shifts):.2f}, mean absolute {np.mean(absShifts):.2f}, max absolute {np.max(absShifts)}')
+    logging.info(f'games shifted by more than 5: {np.mean(absShifts > 5):.1%}, by more than 10: {np.mean(absShifts > 10):.1%}')
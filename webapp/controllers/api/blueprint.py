@@ -1,69 +1,267 @@
 import logging
+from typing import Dict, List
 from flask import Blueprint, Response, request, jsonify, json
 from webapp.DefaultResponse import Success, BadRequest, NotAvailable
-from webapp.metrics import record_activation, record_job_started, record_job_completed
+from webapp.metrics import record_activation, record_job_started, record_job_completed, record_leases_reclaimed
 
-from modules.game.AnalysedGame import GameAnalysedGame
+from modules.game.AnalysedGame import GameAnalysedGame, AnalysedGameBSONHandler
 from modules.irwin.PlayerReport import PlayerReport
 from modules.auth.Priv import RequestJob, CompleteJob, PostJob
 from modules.queue.Origin import OriginReport, OriginModerator, OriginRandom
 from modules.client.Job import Job
+from modules.client.Wire import Wire
 import traceback
 
 def buildApiBlueprint(env):
     apiBlueprint = Blueprint('Api', __name__, url_prefix='/api')
 
-    @apiBlueprint.route('/request_job', methods=['GET'])
-    @env.auth.authoriseRoute(RequestJob)
-    def apiRequestJob(authable):
-        engineQueue = env.queue.nextEngineAnalysis(authable.id)
-        logging.debug(f'EngineQueue for req {engineQueue}')
-        if engineQueue is not None:
-            requiredGames = env.gameApi.gamesForAnalysis(engineQueue.id, engineQueue.requiredGameIds)
-            requiredGames = requiredGames[:50]
-            requiredGameIds = [g.id for g in requiredGames]
+    def buildJob(engineQueue, req, authable) -> Job:
+        # a moderator is waiting for these, so the client trades depth for time
+        moderatorSeconds = env.config['queue moderator_seconds']
+        targetSeconds = moderatorSeconds if engineQueue.origin == OriginModerator and moderatorSeconds > 0 else None
+
+        # lichess's analysis is needed to rank the games, and by clients that take played move
+        # evals from it or weigh positions with it to fit a job into its target time
+        rank = req.get('rank', False)
+        analysis = rank or req.get('gameEvals', False) or targetSeconds is not None
+        # a moderator gets the games a pipeline client only triaged analysed deeply
+        deep = engineQueue.origin == OriginModerator
+        requiredGames = env.gameApi.gamesForAnalysis(engineQueue.id, engineQueue.requiredGameIds, analysis, deep)
+        if rank:
+            # most suspicious first, so clients that stop a job early have analysed the games that matter
+            predictions = env.irwin.basicGameModel.predict(engineQueue.id, requiredGames)
+            requiredGames = [g for g, p in sorted(zip(requiredGames, predictions), key=lambda gp: gp[1], reverse=True)]
+        requiredGames = requiredGames[:50]
+        requiredGameIds = [g.id for g in requiredGames]
+
+        logging.warning(f'Requesting {authable.name} analyses {requiredGameIds} for {engineQueue.id}')
+
+        # serve cached analyses only when the client tells us what it would have computed
+        nodes, engine = req.get('nodes'), req.get('engine')
+        analysedPositions = [] if None in [nodes, engine] else env.gameApi.analysedPositionsForGames(engineQueue.id, requiredGames, nodes, engine)
+
+        if rank and not req.get('gameEvals', False) and targetSeconds is None:
+            requiredGames = [g._replace(analysis=[]) for g in requiredGames]
 
-            logging.warning(f'Requesting {authable.name} analyses {requiredGameIds} for {engineQueue.id}')
+        job = Job(
+            playerId = engineQueue.id,
+            games = requiredGames,
+            analysedPositions = analysedPositions,
+            targetSeconds = targetSeconds,
+            deep = deep)
 
-            job = Job(
-                playerId = engineQueue.id,
-                games = requiredGames,
-                analysedPositions = [])
+        logging.info(f'Job: {job}')
+        record_job_started(engineQueue.id, engineQueue.date)
+        return job
 
-            logging.info(f'Job: {job}')
-            record_job_started(engineQueue.id, engineQueue.date)
+    @apiBlueprint.route('/request_job', methods=['GET'])
+    @env.auth.authoriseRoute(RequestJob)
+    def apiRequestJob(authable):
+        """
+        Lease a job. A client that sends a `count` may lease up to that many at once
+        (at most `queue max_jobs`), and is answered with a list of `jobs`. With `rank`
+        each job's games are ordered most suspicious first. With `heartbeat` the client
+        keeps its leases with heartbeats, and they expire if it stops sending them.
+        """
+        req = request.get_json(silent=True)
+        try:
+            count = max(1, min(int(req.get('count', 1)), env.config['queue max_jobs']))
+        except (TypeError, ValueError):
+            return BadRequest
+        # jobs of clients that stopped sending heartbeats are up for grabs again
+        reclaimed = env.queue.reclaimExpiredLeases()
+        if reclaimed > 0:
+            logging.warning(f'Reclaimed {reclaimed} expired job leases')
+            record_leases_reclaimed(reclaimed)
+        # jobs the client is still analysing or uploading
+        engineQueues = env.queue.nextEngineAnalyses(authable.id, count, req.get('exclude', []), req.get('heartbeat', False))
+        logging.debug(f'EngineQueues for req {engineQueues}')
+        if len(engineQueues) > 0:
+            jobs = [buildJob(engineQueue, req, authable).toJson() for engineQueue in engineQueues]
 
+            # clients that read the packed encoding get it, and send their results back packed
+            packed = Wire.packed in req.get('encodings', [])
+            if 'count' in req:
+                payload = {'jobs': jobs}
+            else:
+                payload = {'job': jobs[0]} if packed else jobs[0]
             return  Response(
-                response = json.dumps(job.toJson()),
+                response = json.dumps(Wire.pack(payload) if packed else payload),
                 status = 200,
                 mimetype = 'application/json')
         return NotAvailable
 
+    def playerReport(playerId, owner) -> PlayerReport:
+        """
+        Predict every analysed game stored for the player and build their report
+        """
+        player = env.irwin.env.playerDB.byId(playerId)
+        analysedGames = [ag for ag in env.irwin.env.analysedGameDB.byPlayerId(playerId) if ag.gameLength() <= 60]
+        games = env.irwin.env.gameDB.byIds([ag.gameId for ag in analysedGames])
+        predictions = env.irwin.analysedGameModel.predict([GameAnalysedGame(ag, g) for ag, g in zip(analysedGames, games)])
+
+        return PlayerReport.new(player, zip(analysedGames, predictions), owner = owner)
+
+    def gameActivations(analysedGamesBSON: List[Dict]) -> List[int]:
+        """
+        Activations of the analysed game model for the games it could predict
+        """
+        analysedGames = [AnalysedGameBSONHandler.reads(ag) for ag in analysedGamesBSON]
+        games = {g.id: g for g in env.irwin.env.gameDB.byIds([ag.gameId for ag in analysedGames]) if g is not None}
+        analysedGames = [ag for ag in analysedGames if ag.gameId in games and ag.gameLength() <= 60]
+        predictions = env.irwin.analysedGameModel.predict([GameAnalysedGame(ag, games[ag.gameId]) for ag in analysedGames])
+        return [int(p.weightedGamePrediction()) for p in predictions if p is not None]
+
+    def completeJob(job: Job, analysedGamesBSON: List[Dict], authable) -> Response:
+        insertRes = env.gameApi.writeAnalysedGames(analysedGamesBSON)
+        if insertRes:
+            env.gameApi.writeAnalysedPositions(job.analysedPositions)
+            env.queue.completeEngineAnalysis(job.playerId)
+            record_job_completed(job.playerId)
+
+            report = playerReport(job.playerId, authable.name)
+            logging.warning(f'Sending player report for {report.playerId}, activation {report.activation}%')
+            record_activation(report.activation)
+            env.lichessApi.postReport(report)
+
+            return Success
+        return BadRequest
+
     @apiBlueprint.route('/complete_job', methods=['POST'])
     @env.auth.authoriseRoute(CompleteJob)
     def apiCompleteJob(authable):
-        req = request.get_json(silent=True)
         try:
+            req = Wire.unpack(request.get_json(silent=True))
             job = Job.fromJson(req['job'])
-            insertRes = env.gameApi.writeAnalysedGames(req['analysedGames'])
-            if insertRes:
-                env.queue.completeEngineAnalysis(job.playerId)
-                record_job_completed(job.playerId)
+            return completeJob(job, req['analysedGames'], authable)
+        except (KeyError, ValueError) as e:
+            tb = traceback.format_exc()
+            logging.warning(f'Error completing job: {tb}')
+
+        return BadRequest
 
-                player = env.irwin.env.playerDB.byId(job.playerId)
-                analysedGames = env.irwin.env.analysedGameDB.byPlayerId(job.playerId)
-                games = env.irwin.env.gameDB.byIds([ag.gameId for ag in analysedGames])
-                predictions = env.irwin.analysedGameModel.predict([GameAnalysedGame(ag, g) for ag, g in zip(analysedGames, games) if ag.gameLength() <= 60])
+    @apiBlueprint.route('/submit_game', methods=['POST'])
+    @env.auth.authoriseRoute(CompleteJob)
+    def apiSubmitGame(authable):
+        """
+        Store one analysed game of a job leased to the client, as soon as it is done.
+        If `report` is set, answer with the running activation over the job's games
+        submitted so far. Only this game is predicted: the client sends the `activations`
+        of the earlier ones, as it was answered with them last time.
+        """
+        try:
+            req = Wire.unpack(request.get_json(silent=True))
+            playerId = req['playerId']
+            if not env.queue.leasedTo(playerId, authable.id):
+                logging.warning(f'{authable.name} submitted a game for {playerId}, which it has not leased')
+                return BadRequest
+            if env.gameApi.writeAnalysedGames([req['analysedGame']]):
+                if req.get('report', False):
+                    player = env.irwin.env.playerDB.byId(playerId)
+                    activations = [int(a) for a in req.get('activations', [])] + gameActivations([req['analysedGame']])
+                    return Response(
+                        response = json.dumps({
+                            'success': True,
+                            'message': 'action completed successfully',
+                            'activation': PlayerReport.playerActivation(player, activations),
+                            'games': len(activations),
+                            'activations': activations}),
+                        status = 200,
+                        mimetype = 'application/json')
+                return Success
+        except (KeyError, ValueError) as e:
+            tb = traceback.format_exc()
+            logging.warning(f'Error submitting game: {tb}')
 
-                playerReport = PlayerReport.new(player, zip(analysedGames, predictions), owner = authable.name)
-                logging.warning(f'Sending player report for {playerReport.playerId}, activation {playerReport.activation}%')
-                record_activation(playerReport.activation)
-                env.lichessApi.postReport(playerReport)
+        return BadRequest
 
+    @apiBlueprint.route('/release_job', methods=['POST'])
+    @env.auth.authoriseRoute(RequestJob)
+    def apiReleaseJob(authable):
+        """
+        Give back a job the client will not finish, so any client can take it up.
+        Games already submitted for it are kept.
+        """
+        try:
+            req = Wire.unpack(request.get_json(silent=True))
+            playerId = req['playerId']
+            if env.queue.releaseEngineAnalysis(playerId, authable.id):
+                logging.warning(f'{authable.name} released {playerId}')
                 return Success
-        except KeyError as e:
+            logging.warning(f'{authable.name} tried to release {playerId}, which it has not leased')
+        except (KeyError, ValueError) as e:
             tb = traceback.format_exc()
-            logging.warning(f'Error completing job: {tb}')
+            logging.warning(f'Error releasing job: {tb}')
+
+        return BadRequest
+
+    @apiBlueprint.route('/heartbeat', methods=['POST'])
+    @env.auth.authoriseRoute(RequestJob)
+    def apiHeartbeat(authable):
+        """
+        Extend the leases on the jobs the client holds. `progress` maps each player to
+        how far the client is with their job, and is stored with the queue entry.
+        Answers with whether each lease is still held.
+        """
+        try:
+            req = Wire.unpack(request.get_json(silent=True))
+            leases = {playerId: env.queue.heartbeat(playerId, authable.id, progress) for playerId, progress in req['progress'].items()}
+            lost = [playerId for playerId, held in leases.items() if not held]
+            if len(lost) > 0:
+                logging.warning(f'{authable.name} sent a heartbeat for {lost}, which it no longer holds')
+            return Response(
+                response = json.dumps({'leases': leases}),
+                status = 200,
+                mimetype = 'application/json')
+        except (KeyError, ValueError, AttributeError) as e:
+            tb = traceback.format_exc()
+            logging.warning(f'Error in heartbeat: {tb}')
+
+        return BadRequest
+
+    @apiBlueprint.route('/rank_games', methods=['POST'])
+    @env.auth.authoriseRoute(CompleteJob)
+    def apiRankGames(authable):
+        """
+        Predict shallow analyses of a leased job's games, so the client knows which
+        games to analyse deeply. Nothing is stored.
+        """
+        try:
+            req = Wire.unpack(request.get_json(silent=True))
+            playerId = req['playerId']
+            if not env.queue.leasedTo(playerId, authable.id):
+                logging.warning(f'{authable.name} asked to rank games for {playerId}, which it has not leased')
+                return BadRequest
+            analysedGames = [AnalysedGameBSONHandler.reads(ag) for ag in req['analysedGames']]
+            games = {g.id: g for g in env.irwin.env.gameDB.byIds([ag.gameId for ag in analysedGames]) if g is not None}
+            analysedGames = [ag for ag in analysedGames if ag.gameId in games]
+            predictions = env.irwin.analysedGameModel.predict([GameAnalysedGame(ag, games[ag.gameId]) for ag in analysedGames])
+
+            activations = {ag.gameId: (None if p is None else p.weightedGamePrediction()) for ag, p in zip(analysedGames, predictions)}
+            return Response(
+                response = json.dumps({'activations': activations}),
+                status = 200,
+                mimetype = 'application/json')
+        except (KeyError, ValueError) as e:
+            tb = traceback.format_exc()
+            logging.warning(f'Error ranking games: {tb}')
+
+        return BadRequest
+
+    @apiBlueprint.route('/finalize_job', methods=['POST'])
+    @env.auth.authoriseRoute(CompleteJob)
+    def apiFinalizeJob(authable):
+        """
+        Close a job whose games were sent through submit_game and report the player.
+        Games that could not be submitted may be sent along in `analysedGames`.
+        """
+        try:
+            req = Wire.unpack(request.get_json(silent=True))
+            job = Job.fromJson(req['job'])
+            return completeJob(job, req.get('analysedGames', []), authable)
+        except (KeyError, ValueError) as e:
+            tb = traceback.format_exc()
+            logging.warning(f'Error finalizing job: {tb}')
 
         return BadRequest
 
@@ -1,4 +1,4 @@
-from prometheus_client import Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from flask import Response
 from datetime import datetime
 from typing import Dict
@@ -40,6 +40,11 @@ processing_time = Histogram(
     buckets=PROCESSING_BUCKETS
 )
 
+leases_reclaimed = Counter(
+    'irwin_leases_reclaimed',
+    'Job leases put back in the queue after their client stopped sending heartbeats'
+)
+
 # Track when jobs were started (playerId -> start time)
 _job_start_times: Dict[str, datetime] = {}
 
@@ -55,6 +60,10 @@ def record_job_started(player_id: str, queued_at: datetime) -> None:
     _job_start_times[player_id] = now
 
 
+def record_leases_reclaimed(count: int) -> None:
+    leases_reclaimed.inc(count)
+
+
 def record_job_completed(player_id: str) -> None:
     start_time = _job_start_times.pop(player_id, None)
     if start_time is not None: